@@ -1,12 +1,76 @@
 # a set of functions that are related to binning spikes/events
 # bincount2D bins any data in 2 dimensions e.g. spikes+ clusters so used ot crease heatmaps
 
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import mmap
+from multiprocessing import shared_memory
+import os
+
 import numpy as np
-from scipy.signal import convolve
+from scipy.fft import irfft, next_fast_len, rfft
 from scipy.signal.windows import gaussian
-from .io import Bunch
+from scipy.sparse import coo_matrix, issparse
+from .io import Bunch, SpikeTable
+
+# number of float64 values per block when smoothing (bounds the size of the fft temporaries)
+SMOOTHING_BLOCK_SIZE = 2 ** 22
+# number of raster values (events x clusters x bins) binned at once by get_binned_rasters
+RASTER_BLOCK_SIZE = 2 ** 24
+# below this number of events x clusters get_binned_rasters_parallel runs serially
+PARALLEL_MIN_SIZE = 2 ** 16
+
+
+def half_gaussian_window(w, std):
+    """
+    Causal half-gaussian kernel used to smooth binned data
+    :param w: number of samples of the window
+    :param std: standard deviation of the gaussian, in samples
+    :return: window [w], normalised to sum to 1
+    """
+    window = gaussian(w, std=std)
+    # half (causal) gaussian filter
+    window[: int(np.ceil(w / 2))] = 0
+    window /= np.sum(window)
+    return window
+
+
+@lru_cache(maxsize=32)
+def _half_gaussian_spectrum(w, std, nfft):
+    # the spectrum is shared between calls so it is made read-only
+    spectrum = rfft(half_gaussian_window(w, std), nfft)
+    spectrum.flags.writeable = False
+    return spectrum
+
+
+def smooth_half_gaussian(r, w, std, out=None):
+    """
+    Smooths every row of a 2D/3D array along its last (time) axis with a causal half-gaussian.
+    Equivalent to scipy.signal.convolve(row, half_gaussian_window(w, std), mode="same") for
+    each row, but all rows are convolved at once in the frequency domain, block by block, and the
+    kernel spectrum is cached across calls with the same parameters.
+    :param r: array [..., nt]
+    :param w: number of samples of the window
+    :param std: standard deviation of the gaussian, in samples
+    :param out: (optional) output array with the shape of r, can be r itself for in-place smoothing
+    :return: smoothed array [..., nt]
+    """
+    nt = r.shape[-1]
+    nfft = next_fast_len(nt + w - 1, real=True)
+    spectrum = _half_gaussian_spectrum(int(w), float(std), nfft)
+    # "same" mode keeps the centre of the full convolution
+    first = (w - 1) // 2
+    if out is None:
+        out = np.empty(r.shape, dtype=np.result_type(r.dtype, np.float32))
+    rows, rows_out = r.reshape(-1, nt), out.reshape(-1, nt)
+    block_size = max(1, SMOOTHING_BLOCK_SIZE // nfft)
+    for i in range(0, rows.shape[0], block_size):
+        sr = rfft(rows[i : i + block_size], nfft, axis=-1)
+        sr *= spectrum
+        rows_out[i : i + block_size] = irfft(sr, nfft, axis=-1)[:, first : first + nt]
+    return out
 
-def bincount2D(x, y, xbin=0, ybin=0, xlim=None, ylim=None, weights=None, xsmoothing=0):
+def bincount2D(x, y, xbin=0, ybin=0, xlim=None, ylim=None, weights=None, xsmoothing=0, sparse=False):
     """
     Computes a 2D histogram by aggregating values in a 2D array. Used if you want a binned version of your spike/event data for example
     :param x: values to bin along the 2nd dimension (c-contiguous)
@@ -23,8 +87,13 @@ def bincount2D(x, y, xbin=0, ybin=0, xlim=None, ylim=None, weights=None, xsmooth
     :param ylim: (optional) 2 values (array or list) that restrict range along 1st dimension
     :param weights: (optional) defaults to None, weights to apply to each value for aggregation
     :param xsmoothing: (optional) smoothing along the x axis with a half-gaussian, with sigma given by this value
+    :param sparse: (optional) defaults to False, if True MAP is returned as a scipy.sparse CSR matrix built
+        directly from the bin indices, without materialising the dense image, values outside of
+        xlim / ylim are dropped. Cannot be combined with xsmoothing
     :return: 3 numpy arrays MAP [ny,nx] image, xscale [nx], yscale [ny]
     """
+    if sparse and xsmoothing > 0:
+        raise ValueError("xsmoothing is not supported with sparse output")
     # if no bounds provided, use min/max of vectors
     if xlim is None:
         xlim = [np.min(x), np.max(x)]
@@ -41,8 +110,28 @@ def bincount2D(x, y, xbin=0, ybin=0, xlim=None, ylim=None, weights=None, xsmooth
             scale, ind = np.unique(v, return_inverse=True)
         return scale, ind
 
+    def _exact_values_indices(ind, scale, values):
+        # re-index the bins onto the requested values, -1 for bins that are not requested
+        _, iout, ir = np.intersect1d(values, scale, return_indices=True)
+        lut = np.full(scale.size, -1, dtype=np.int64)
+        lut[ir] = iout
+        return lut[ind]
+
     xscale, xind = _get_scale_and_indices(x, xbin, xlim)
     yscale, yind = _get_scale_and_indices(y, ybin, ylim)
+
+    if sparse:
+        if not np.isscalar(xbin) and xbin.size > 1:
+            xind, xscale = _exact_values_indices(xind, xscale, xbin), xbin
+        if not np.isscalar(ybin) and ybin.size > 1:
+            yind, yscale = _exact_values_indices(yind, yscale, ybin), ybin
+        # entries outside of xlim / ylim (or not in the requested values, -1) are dropped
+        keep = (xind >= 0) & (xind < xscale.size) & (yind >= 0) & (yind < yscale.size)
+        data = np.ones(np.sum(keep)) if weights is None else np.asarray(weights)[keep]
+        # duplicate entries are summed when converting to CSR
+        r = coo_matrix((data, (yind[keep], xind[keep])), shape=(yscale.size, xscale.size)).tocsr()
+        return r, xscale, yscale
+
     # aggregate by using bincount on absolute indices for a 2d array
     nx, ny = [xscale.size, yscale.size]
     ind2d = np.ravel_multi_index(np.c_[yind, xind].transpose(), dims=(ny, nx))
@@ -65,37 +154,311 @@ def bincount2D(x, y, xbin=0, ybin=0, xlim=None, ylim=None, weights=None, xsmooth
 
     if xsmoothing > 0:
         w = xscale.size  # [tscale.size - 1 if tscale.size % 2 == 0 else tscale.size]
-        window = gaussian(w, std=xsmoothing / xbin)
-        # half (causal) gaussian filter
-        window[: int(np.ceil(w / 2))] = 0
-        window /= np.sum(window)  #
-        binned_spikes_conv = [
-            convolve(r[j, :], window, mode="same", method="auto")[:, np.newaxis]
-            for j in range(r.shape[0])
-        ]  # [:-1]
-        r = np.concatenate(binned_spikes_conv, axis=1).T
+        r = smooth_half_gaussian(r, w, xsmoothing / xbin)
 
     return r, xscale, yscale
 
-def digitise_event_onsets(ev_times, bin_range=None, **binkwargs):
+def digitise_event_onsets(ev_times, bin_range=None, output="dense", **binkwargs):
     """
     function to digitise event onsets and if called return bin indices. Wrapped around bincount2D.
+    When binning with a scalar xbin, the onset bins are computed directly from the event times
+    and the digitised trace is only built if requested.
 
+    :param ev_times: event times
+    :param bin_range: (optional) [t_before, t_after] window around each onset, in the units of ev_times
+    :param output: format of the digitised trace: 'dense' the bincount2D [1, nx] map (or a CSR
+        matrix with sparse=True), 'packed' the [1, nx] boolean map of the bins holding events packed
+        with np.packbits along axis 1, None not to build it
+    :param binkwargs: bincount2D keyword arguments, e.g. xbin, xlim. With a scalar xbin, events
+        outside of the bins set by xlim are dropped
+    :return: digitised trace, onset bin indices, bin2show [n_onsets, n_window_bins] bin indices of the
+        window around each onset (None if no bin_range)
     """
-    myev_digi, t, _ = bincount2D(ev_times, np.ones(ev_times.size), **binkwargs)
-    onset_idx = np.where(myev_digi[0, :] == 1)[0]
+    if output not in ["dense", "packed", None]:
+        raise ValueError(f"output must be 'dense', 'packed' or None, got {output}")
+    xbin = binkwargs.get("xbin", 0)
+    index_only = np.isscalar(xbin) and xbin != 0 and set(binkwargs) <= {"xbin", "xlim", "sparse"}
+
+    if np.isscalar(xbin) and xbin != 0:
+        # same bin indices as bincount2D: events outside of the bins set by xlim are dropped,
+        # whatever the output format
+        xlim = binkwargs.get("xlim", None)
+        if xlim is None:
+            xlim = [np.min(ev_times), np.max(ev_times)]
+        nx = np.arange(xlim[0], xlim[1] + xbin / 2, xbin).size
+        xind = (np.floor((ev_times - xlim[0]) / xbin)).astype(np.int64)
+        in_range = np.bitwise_and(xind >= 0, xind < nx)
+        ev_times, xind = ev_times[in_range], xind[in_range]
+        binkwargs["xlim"] = xlim
+
+    if index_only:
+        # same bin indices as bincount2D, without building the map
+        # onsets are the bins that hold exactly one event
+        bins, counts = np.unique(xind, return_counts=True)
+        onset_idx = bins[counts == 1]
+        if output == "dense":
+            myev_digi, _, _ = bincount2D(ev_times, np.ones(ev_times.size), **binkwargs)
+        elif output == "packed":
+            myev_digi = np.zeros((1, int(np.ceil(nx / 8))), dtype=np.uint8)
+            np.bitwise_or.at(
+                myev_digi[0], bins >> 3, (128 >> (bins & 7)).astype(np.uint8)
+            )
+        else:
+            myev_digi = None
+    else:
+        myev_digi, t, _ = bincount2D(ev_times, np.ones(ev_times.size), **binkwargs)
+        if issparse(myev_digi):
+            # read the onsets from the stored entries of the first row
+            myev_digi.sort_indices()
+            row = slice(myev_digi.indptr[0], myev_digi.indptr[1])
+            onset_idx = myev_digi.indices[row][myev_digi.data[row] == 1]
+        else:
+            onset_idx = np.where(myev_digi[0, :] == 1)[0]
+        if output == "packed":
+            first_row = myev_digi[:1, :].toarray() if issparse(myev_digi) else myev_digi[:1, :]
+            myev_digi = np.packbits(first_row > 0, axis=1)
+        elif output is None:
+            myev_digi = None
 
     if bin_range:
         t_before, t_after = bin_range[0], bin_range[1]
         t_bin = binkwargs["xbin"]
         bin_range = np.arange(t_before / t_bin, t_after / t_bin).astype("int")
-        bin2show = [(bin_range + idx)[np.newaxis, :] for idx in onset_idx]
-        bin2show = np.concatenate(bin2show, axis=0)
+        bin2show = onset_idx[:, np.newaxis] + bin_range[np.newaxis, :]
     else:
         bin2show = None
 
     return myev_digi, onset_idx, bin2show
 
+def _spike_arrays(spike_times, spike_clusters):
+    """
+    A SpikeTable can be passed in place of the spike times, its clusters are then used
+    :return: spike_times, spike_clusters
+    """
+    if isinstance(spike_times, SpikeTable):
+        return spike_times.times, spike_times.clusters
+    return spike_times, spike_clusters
+
+
+def _uneven_bin_indices(rel_spike_times, tscale):
+    """
+    Bin indices of spike times relative to the align time for uneven bin edges tscale:
+    the number of edges smaller than the spike time minus 1, in O(n log(bins)).
+    """
+    # subtracting 1 because we start the indexing at 0 (1st bin edge only = 0th index)
+    return np.searchsorted(tscale, rel_spike_times, side="left").astype(np.int64) - 1
+
+
+def _bin_rasters_loop(spike_times, spike_clusters, ids, align_times, tscale, dtype=np.float64):
+    """
+    Reference engine of get_binned_rasters: bins the spikes event by event.
+    :return: spike counts [n_events, n_ids, tscale.size], the last bin holds the spikes on the last edge
+    """
+    binned_spikes = np.zeros(shape=(len(align_times), ids.size, tscale.size), dtype=dtype)
+
+    # determine whether tscale is even or uneven (different indexing)
+    bin_sizes = np.diff(tscale)
+    unique_bin_size = (
+        np.unique((bin_sizes / bin_sizes[0]).round(decimals=1)) * bin_sizes[0]
+    )
+
+    # bin spikes
+    for i, t_0 in enumerate(align_times):
+        # define bin edges
+        ts = tscale + t_0
+        # filter spikes
+        idxs = np.bitwise_and(spike_times >= ts[0], spike_times <= ts[-1])
+        i_spikes = spike_times[idxs]
+        i_clusters = spike_clusters[idxs]
+
+        # bin spikes similar to bincount2D: x = spike times, y = spike clusters
+        xscale = ts
+        # if the bins are evenly spaced, one can just divide by bin size to get bin index
+        if unique_bin_size.size == 1:
+            xind = (np.floor((i_spikes - np.min(ts)) / bin_sizes[0])).astype(np.int64)
+        else:
+            # if not, count the bin edges that are smaller than the spike time
+            xind = _uneven_bin_indices(i_spikes - t_0, tscale)
+
+        yscale, yind = np.unique(i_clusters, return_inverse=True)
+        nx, ny = [xscale.size, yscale.size]
+        ind2d = np.ravel_multi_index(np.c_[yind, xind].transpose(), dims=(ny, nx))
+        r = np.bincount(ind2d, minlength=nx * ny, weights=None).reshape(ny, nx)
+
+        # store
+        bs_idxs = np.isin(ids, yscale)
+        binned_spikes[i, bs_idxs, :] = r
+
+    return binned_spikes
+
+
+def _bin_rasters_vectorized(spike_times, spike_clusters, ids, align_times, tscale, dtype=np.float64):
+    """
+    Vectorized engine of get_binned_rasters: finds the spikes of every event window with
+    searchsorted and bins all events with a single bincount. Spike times must be sorted.
+    :return: spike counts [n_events, n_ids, tscale.size], the last bin holds the spikes on the last edge
+    """
+    align_times = np.asarray(align_times)
+    n_events, n_ids, nx = align_times.size, ids.size, tscale.size
+
+    # window edges are included, as in the reference engine
+    ts_first = align_times + tscale[0]
+    i_first = np.searchsorted(spike_times, ts_first, side="left")
+    i_last = np.searchsorted(spike_times, align_times + tscale[-1], side="right")
+    n_spikes = i_last - i_first
+
+    # event index and spike index of every (event, spike) pair
+    ievent = np.repeat(np.arange(n_events), n_spikes)
+    ispike = np.arange(n_spikes.sum()) + np.repeat(
+        i_first - np.cumsum(n_spikes) + n_spikes, n_spikes
+    )
+    i_spikes = spike_times[ispike]
+
+    bin_sizes = np.diff(tscale)
+    unique_bin_size = (
+        np.unique((bin_sizes / bin_sizes[0]).round(decimals=1)) * bin_sizes[0]
+    )
+    if unique_bin_size.size == 1:
+        xind = (np.floor((i_spikes - ts_first[ievent]) / bin_sizes[0])).astype(np.int64)
+    else:
+        xind = _uneven_bin_indices(i_spikes - align_times[ievent], tscale)
+    yind = np.searchsorted(ids, spike_clusters[ispike])
+
+    valid = np.bitwise_and(xind >= 0, xind < nx)
+    ind3d = (ievent[valid] * n_ids + yind[valid]) * nx + xind[valid]
+    r = np.bincount(ind3d, minlength=n_events * n_ids * nx).reshape(n_events, n_ids, nx)
+    return r.astype(dtype)
+
+
+def _raster_time_scale(tscale, pre_time, post_time, bin_size, smoothing):
+    """
+    Bin edges relative to the align times used by get_binned_rasters
+    :return: tscale, n_bins, n_offset (bins padded on each side for smoothing), smoothing,
+        margin (time added on each side of the event windows when filtering spikes)
+    """
+    # compute floating tscale if not supplied - in this case smoothing can be requested
+    if tscale[0] == None:
+        n_offset = 5 * int(
+            np.ceil(smoothing / bin_size)
+        )  # get rid of boundary effects for smoothing
+        n_bins_pre = int(np.ceil(pre_time / bin_size)) + n_offset
+        n_bins_post = int(np.ceil(post_time / bin_size)) + n_offset
+        n_bins = n_bins_pre + n_bins_post
+        tscale = np.arange(-n_bins_pre, n_bins_post + 1) * bin_size
+        margin = bin_size
+    else:
+        # if floating tscale is supplied smoothing cannot be requested
+        tscale = np.asarray(tscale)
+        smoothing = 0
+        n_offset = 0
+        n_bins = tscale.size - 1  # -1 as it represents bin edges?
+        margin = 0
+    return tscale, n_bins, n_offset, smoothing, margin
+
+
+def _raster_finalisation(tscale, n_bins, n_offset, bin_size, smoothing, return_fr, baseline_subtract):
+    """
+    Turns spike counts [n_events, n_ids, tscale.size] into the output rasters of get_binned_rasters
+    :return: ts (bin centres), finalise function that smooths, normalises and baseline-subtracts
+        the counts in place and returns the view of the output bins
+    """
+    # bins that are kept in the output: the smoothing offset bins are discarded
+    first, last = (n_offset, n_bins - n_offset) if smoothing > 0 else (0, n_bins)
+    bin_sizes = np.diff(tscale)[first:last]
+    # output time scale: bin centres
+    ts = tscale[first : last + 1]
+    ts = (ts[:-1] + ts[1:]) / 2
+
+    def finalise(binned_spikes_):
+        # smooth (the last edge bin takes part in the smoothing)
+        if smoothing > 0:
+            w = n_bins - 1 if n_bins % 2 == 0 else n_bins
+            smooth_half_gaussian(binned_spikes_, w, smoothing / bin_size, out=binned_spikes_)
+        binned_spikes_ = binned_spikes_[:, :, first:last]
+
+        if return_fr:
+            # to account also for uneven binsizes
+            binned_spikes_ /= bin_sizes
+
+        if baseline_subtract:
+            # subtract the mean baseline (i.e. the mean before 0 on the tscale)
+            binned_spikes_ -= binned_spikes_[:, :, ts < 0].mean(axis=2, keepdims=True)
+        return binned_spikes_
+
+    return ts, finalise
+
+
+def _raster_blocks(
+    spike_times,
+    spike_clusters,
+    cluster_ids,
+    align_times,
+    tscale,
+    pre_time,
+    post_time,
+    bin_size,
+    smoothing,
+    return_fr,
+    baseline_subtract,
+    engine,
+    dtype,
+):
+    """
+    Bins, smooths and normalises the rasters of get_binned_rasters one block of events at a time
+    :return: ts (bin centres), ids (cluster ids), generator of (event slice, rasters of these events
+        [n_block_events, n_ids, ts.size])
+    """
+    engines = {"vectorized": _bin_rasters_vectorized, "loop": _bin_rasters_loop}
+    if engine not in engines:
+        raise ValueError(f"engine must be one of {list(engines.keys())}, got {engine}")
+
+    tscale, n_bins, n_offset, smoothing, margin = _raster_time_scale(
+        tscale, pre_time, post_time, bin_size, smoothing
+    )
+    # time range spanned by all the event windows
+    total_trange = [
+        np.min(align_times) + tscale[0] - margin,
+        np.max(align_times) + tscale[-1] + margin,
+    ]
+
+    ids = np.unique(cluster_ids)
+
+    # filter spikes outside of the loop
+    is_sorted = isinstance(spike_times, SpikeTable)
+    if is_sorted:
+        # the table is sorted by time: the time range is a slice
+        sl = spike_times.window_slice(*total_trange)
+        spike_times, spike_clusters = spike_times.times[sl], spike_times.clusters[sl]
+        idxs = np.isin(spike_clusters, cluster_ids)
+    else:
+        idxs = np.bitwise_and(
+            spike_times >= total_trange[0], spike_times <= total_trange[1]
+        )
+        idxs = np.bitwise_and(idxs, np.isin(spike_clusters, cluster_ids))
+    spike_times = spike_times[idxs]
+    spike_clusters = spike_clusters[idxs]
+
+    if engine == "vectorized" and not is_sorted and np.any(np.diff(spike_times) < 0):
+        # sort once so that the spikes of each event window are a contiguous slice
+        isort = np.argsort(spike_times, kind="stable")
+        spike_times, spike_clusters = spike_times[isort], spike_clusters[isort]
+
+    ts, finalise = _raster_finalisation(
+        tscale, n_bins, n_offset, bin_size, smoothing, return_fr, baseline_subtract
+    )
+
+    def blocks():
+        block_size = max(1, RASTER_BLOCK_SIZE // max(1, ids.size * (n_bins + 1)))
+        for i in range(0, align_times.size, block_size):
+            binned_spikes_ = engines[engine](
+                spike_times, spike_clusters, ids, align_times[i : i + block_size], tscale,
+                dtype=dtype,
+            )
+            yield slice(i, i + block_size), finalise(binned_spikes_)
+
+    return ts, ids, blocks()
+
+
 def get_binned_rasters(
     spike_times,
     spike_clusters,
@@ -108,13 +471,16 @@ def get_binned_rasters(
     smoothing=0.025,
     return_fr=True,
     baseline_subtract=False,
+    engine="vectorized",
+    dtype=np.float64,
+    out=None,
 ):
     """
     Bin spikes to create rasters around specific events
 
-    :param spike_times: spike times (in seconds)
+    :param spike_times: spike times (in seconds), or a SpikeTable
     :type spike_times: array-like
-    :param spike_clusters: cluster ids corresponding to each event in `spikes`
+    :param spike_clusters: cluster ids corresponding to each event in `spikes`, ignored for a SpikeTable
     :type spike_clusters: array-like
     :param cluster_ids: subset of cluster ids for calculating rasters
     :type cluster_ids: array-like
@@ -133,139 +499,585 @@ def get_binned_rasters(
     :type smoothing: float
     :param return_fr: `True` to return (estimated) firing rate, `False` to return spike counts
     :type return_fr: bool
+    :param engine: 'vectorized' bins all events at once with a single bincount,
+        'loop' bins event by event and is kept as a reference implementation
+    :type engine: str
+    :param dtype: dtype of the rasters, e.g. np.float32 to halve the memory footprint
+    :type dtype: np.dtype
+    :param out: (optional) array [n_events, n_clusters, n_bins] the rasters are written into,
+        e.g. a memmap; its dtype takes precedence over `dtype`
+    :type out: np.ndarray
+
+    Events are binned, smoothed and normalised block by block directly into the output array,
+    so that the peak memory is about the size of the output.
 
     :return: rasters
     :rtype: rasters: Bunch({'rasters': binned_spikes_, 'tscale': ts, 'cscale': ids})
     """
+    align_times = np.asarray(align_times)
+    ts, ids, blocks = _raster_blocks(
+        spike_times,
+        spike_clusters,
+        cluster_ids,
+        align_times,
+        tscale,
+        pre_time,
+        post_time,
+        bin_size,
+        smoothing,
+        return_fr,
+        baseline_subtract,
+        engine,
+        dtype if out is None else out.dtype,
+    )
 
-    # initialize containers
+    shape = (align_times.size, ids.size, ts.size)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise ValueError(f"out has shape {out.shape}, expected {shape}")
 
-    # compute floating tscale if not supplied - in this case smoothing can be requested
-    if tscale[0] == None:
-        n_offset = 5 * int(
-            np.ceil(smoothing / bin_size)
-        )  # get rid of boundary effects for smoothing
-        n_bins_pre = int(np.ceil(pre_time / bin_size)) + n_offset
-        n_bins_post = int(np.ceil(post_time / bin_size)) + n_offset
-        n_bins = n_bins_pre + n_bins_post
-        tscale = np.arange(-n_bins_pre, n_bins_post + 1) * bin_size
+    for events, binned_spikes_ in blocks:
+        out[events] = binned_spikes_
 
-        # caluate the s
-        total_trange = [
-            np.min(align_times) - (n_bins_pre + 1) * bin_size,
-            np.max(align_times) + (n_bins_post + 1) * bin_size,
-        ]
-    else:
-        # if floating tscale is supplied smoothing cannot be requested
-        smoothing = 0
-        n_bins = tscale.size - 1  # -1 as it represents bin edges?
-        total_trange = [np.min(align_times), np.max(align_times)]
+    rasters = Bunch({"rasters": out, "tscale": ts, "cscale": ids})
 
-    binned_spikes = np.zeros(shape=(len(align_times), len(cluster_ids), n_bins))
+    return rasters
 
-    # build gaussian kernel if requested
-    if smoothing > 0:
-        w = n_bins - 1 if n_bins % 2 == 0 else n_bins
-        window = gaussian(w, std=smoothing / bin_size)
-        # half (causal) gaussian filter
-        window[: int(np.ceil(w / 2))] = 0
-        window /= np.sum(window)
-        binned_spikes_conv = np.copy(binned_spikes)
 
-    ids = np.unique(cluster_ids)
+def iter_binned_rasters(
+    spike_times,
+    spike_clusters,
+    cluster_ids,
+    align_times,
+    events_per_block=256,
+    out=None,
+    **kwargs,
+):
+    """
+    Streaming version of get_binned_rasters for spike arrays that do not fit in memory, e.g.
+    memory-mapped .npy files (np.load(file, mmap_mode='r')). The events are processed in blocks
+    of increasing time and for each block only the slice of the spike arrays overlapping
+    its windows is read.
 
-    # filter spikes outside of the loop
-    idxs = np.bitwise_and(
-        spike_times >= total_trange[0], spike_times <= total_trange[1]
+    :param spike_times: spike times (in seconds), sorted, or a SpikeTable
+    :type spike_times: array-like
+    :param spike_clusters: cluster ids corresponding to each spike
+    :type spike_clusters: array-like
+    :param cluster_ids: subset of cluster ids for calculating rasters
+    :type cluster_ids: array-like
+    :param align_times: times (in seconds) to align rasters to
+    :type align_times: array-like
+    :param events_per_block: number of events binned at once
+    :type events_per_block: int
+    :param out: (optional) array [n_events, n_clusters, n_bins] the rasters are written into,
+        e.g. a memmap created with np.lib.format.open_memmap
+    :type out: np.ndarray
+    :param kwargs: tscale, pre_time, post_time, bin_size, smoothing, return_fr,
+        baseline_subtract, engine and dtype, as in get_binned_rasters
+
+    :return: generator of (event indices, rasters) for each block, rasters is the
+        Bunch({'rasters', 'tscale', 'cscale'}) of these events
+    """
+    spike_times, spike_clusters = _spike_arrays(spike_times, spike_clusters)
+    align_times = np.asarray(align_times)
+    tscale, *_, margin = _raster_time_scale(
+        kwargs.get("tscale", [None]),
+        kwargs.get("pre_time", 0.2),
+        kwargs.get("post_time", 0.5),
+        kwargs.get("bin_size", 0.025),
+        kwargs.get("smoothing", 0.025),
     )
-    idxs = np.bitwise_and(idxs, np.isin(spike_clusters, cluster_ids))
-    spike_times = spike_times[idxs]
-    spike_clusters = spike_clusters[idxs]
+    # blocks of events close in time read contiguous slices of the spike arrays
+    order = np.argsort(align_times, kind="stable")
+    for i in range(0, order.size, events_per_block):
+        iev = order[i : i + events_per_block]
+        first = np.searchsorted(spike_times, align_times[iev[0]] + tscale[0] - margin, side="left")
+        last = np.searchsorted(spike_times, align_times[iev[-1]] + tscale[-1] + margin, side="right")
+        rasters = get_binned_rasters(
+            np.asarray(spike_times[first:last]),
+            np.asarray(spike_clusters[first:last]),
+            cluster_ids,
+            align_times[iev],
+            **kwargs,
+        )
+        if out is not None:
+            out[iev] = rasters.rasters
+        yield iev, rasters
 
-    # determine whether tscale is even or uneven (different indexing)
-    bin_sizes = np.diff(tscale)
-    unique_bin_size = (
-        np.unique((bin_sizes / bin_sizes[0]).round(decimals=1)) * bin_sizes[0]
+
+def get_binned_psth(
+    spike_times,
+    spike_clusters,
+    cluster_ids,
+    align_times,
+    labels=None,
+    tscale=[None],
+    pre_time=0.2,
+    post_time=0.5,
+    bin_size=0.025,
+    smoothing=0.025,
+    return_fr=True,
+    baseline_subtract=False,
+    engine="vectorized",
+):
+    """
+    Trial-averaged rasters (PSTH) and their standard error across trials, computed while binning
+    so that the trial x cluster x time rasters are never held in memory at once. The mean and
+    variance are accumulated block of trials by block of trials.
+
+    :param spike_times: spike times (in seconds), or a SpikeTable
+    :type spike_times: array-like
+    :param spike_clusters: cluster ids corresponding to each event in `spikes`, ignored for a SpikeTable
+    :type spike_clusters: array-like
+    :param cluster_ids: subset of cluster ids for calculating rasters
+    :type cluster_ids: array-like
+    :param align_times: times (in seconds) to align rasters to
+    :type align_times: array-like
+    :param labels: (optional) condition label of each align time, the PSTH is then computed per condition
+    :type labels: array-like
+    :param tscale, pre_time, post_time, bin_size, smoothing, return_fr, baseline_subtract, engine:
+        as in get_binned_rasters
+
+    :return: psth
+    :rtype: psth: Bunch({'mean', 'sem', 'n_trials', 'tscale', 'cscale'}), mean and sem are
+        [n_clusters, n_bins]. If labels are given, mean and sem are [n_conditions, n_clusters, n_bins],
+        n_trials is [n_conditions] and the Bunch also holds 'condscale', the sorted condition labels.
+    """
+    align_times = np.asarray(align_times)
+    if labels is None:
+        condscale, icond = np.zeros(1), np.zeros(align_times.size, dtype=np.int64)
+    else:
+        condscale, icond = np.unique(labels, return_inverse=True)
+        icond = icond.ravel()
+    ts, ids, blocks = _raster_blocks(
+        spike_times,
+        spike_clusters,
+        cluster_ids,
+        align_times,
+        tscale,
+        pre_time,
+        post_time,
+        bin_size,
+        smoothing,
+        return_fr,
+        baseline_subtract,
+        engine,
+        np.float64,
     )
 
-    # bin spikes
-    for i, t_0 in enumerate(align_times):
-        # define bin edges
-        ts = tscale + t_0
-        # filter spikes
-        idxs = np.bitwise_and(spike_times >= ts[0], spike_times <= ts[-1])
-        i_spikes = spike_times[idxs]
-        i_clusters = spike_clusters[idxs]
+    n_trials = np.zeros(condscale.size, dtype=np.int64)
+    mean = np.zeros((condscale.size, ids.size, ts.size))
+    m2 = np.zeros((condscale.size, ids.size, ts.size))  # sum of squared deviations to the mean
+    for events, binned_spikes_ in blocks:
+        block_cond = icond[events]
+        for k in np.unique(block_cond):
+            r = binned_spikes_[block_cond == k]
+            # merge the block statistics into the running ones (Chan et al.)
+            n_block, mean_block = r.shape[0], r.mean(axis=0)
+            m2_block = np.sum((r - mean_block) ** 2, axis=0)
+            n = n_trials[k] + n_block
+            delta = mean_block - mean[k]
+            mean[k] += delta * n_block / n
+            m2[k] += m2_block + delta ** 2 * n_trials[k] * n_block / n
+            n_trials[k] = n
 
-        # bin spikes similar to bincount2D: x = spike times, y = spike clusters
-        xscale = ts
-        # if the bins are evenly spaced, one can just divide by bin size to get bin index
-        if unique_bin_size.size == 1:
-            xind = (np.floor((i_spikes - np.min(ts)) / bin_sizes[0])).astype(np.int64)
-        else:
-            # if not then the binning is a bit more intensive
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sem = np.sqrt(m2 / (n_trials - 1)[:, np.newaxis, np.newaxis]) / np.sqrt(
+            n_trials[:, np.newaxis, np.newaxis]
+        )
+    sem[n_trials < 2] = np.nan
 
-            rel_spike_times = i_spikes - t_0
-            rel_spike_times = np.repeat(
-                rel_spike_times[:, np.newaxis], tscale.size, axis=1
-            )
-            # we subtract the bin edges and check which one is greater than 0
-            # subtracting 1 because we start the indexing at 0 (1st bin edge only = 0th index)
-            xind = (np.sum((rel_spike_times - tscale) > 0, axis=1) - 1).astype(np.int64)
+    if labels is None:
+        return Bunch(
+            {"mean": mean[0], "sem": sem[0], "n_trials": n_trials[0], "tscale": ts, "cscale": ids}
+        )
+    return Bunch(
+        {
+            "mean": mean,
+            "sem": sem,
+            "n_trials": n_trials,
+            "tscale": ts,
+            "cscale": ids,
+            "condscale": condscale,
+        }
+    )
 
-        yscale, yind = np.unique(i_clusters, return_inverse=True)
-        nx, ny = [xscale.size, yscale.size]
-        ind2d = np.ravel_multi_index(np.c_[yind, xind].transpose(), dims=(ny, nx))
-        r = np.bincount(ind2d, minlength=nx * ny, weights=None).reshape(ny, nx)
 
-        # store (ts represent bin edges, so there are one fewer bins)
-        bs_idxs = np.isin(ids, yscale)
-        binned_spikes[i, bs_idxs, :] = r[:, :-1]
+def _memmap_file_offset(x):
+    """
+    Byte offset in its file of the first element of a c-contiguous memmap, None if the array can't
+    be reopened from its file. Slices of a memmap keep the offset of the parent mapping, so the
+    offset is computed from the address of the data within the mapping.
+    """
+    if not isinstance(x, np.memmap) or x.filename is None or not x.flags.c_contiguous:
+        return None
+    if getattr(x, "_mmap", None) is None:
+        return None
+    # the mapping starts at the offset rounded down to the allocation granularity
+    start = x.offset - x.offset % mmap.ALLOCATIONGRANULARITY
+    base = np.frombuffer(x._mmap, dtype=np.uint8).__array_interface__["data"][0]
+    return start + x.__array_interface__["data"][0] - base
 
-        # smooth
-        if smoothing > 0:
-            idxs = np.where(bs_idxs)[0]
-            for j in range(r.shape[0]):
-                binned_spikes_conv[i, idxs[j], :] = convolve(
-                    r[j, :], window, mode="same", method="auto"
-                )[:-1]
-
-    # average
-    if smoothing > 0:
-        binned_spikes_ = np.copy(binned_spikes_conv)
+
+def _share_array(x):
+    """
+    Makes an array available to worker processes without pickling it: memmaps are reopened
+    from their file, other arrays are copied once into shared memory.
+    :return: spec (picklable description of the array), shared memory handle or None
+    """
+    offset = _memmap_file_offset(x)
+    if offset is not None:
+        return ("memmap", x.filename, x.dtype.str, x.shape, offset), None
+    x = np.asarray(x)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, x.nbytes))
+    np.ndarray(x.shape, dtype=x.dtype, buffer=shm.buf)[...] = x
+    return ("shm", shm.name, x.dtype.str, x.shape), shm
+
+
+def _open_shared_array(spec):
+    """
+    Opens an array shared by _share_array from a worker process
+    :return: array, shared memory handle or None (to be closed once the array is not used anymore)
+    """
+    if spec[0] == "memmap":
+        _, filename, dtype, shape, offset = spec
+        return np.memmap(filename, dtype=dtype, mode="r", shape=shape, offset=offset), None
+    _, name, dtype, shape = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=dtype, buffer=shm.buf), shm
+
+
+def _binned_rasters_worker(times_spec, clusters_spec, cluster_ids, align_times, kwargs):
+    spike_times, shm_times = _open_shared_array(times_spec)
+    spike_clusters, shm_clusters = _open_shared_array(clusters_spec)
+    try:
+        rasters = get_binned_rasters(spike_times, spike_clusters, cluster_ids, align_times, **kwargs)
+    finally:
+        del spike_times, spike_clusters
+        for shm in (shm_times, shm_clusters):
+            if shm is not None:
+                shm.close()
+    return rasters
+
+
+def get_binned_rasters_parallel(
+    spike_times,
+    spike_clusters,
+    cluster_ids,
+    align_times,
+    n_workers=None,
+    shard_by="clusters",
+    **kwargs,
+):
+    """
+    Parallel front-end of get_binned_rasters: the clusters (or the events) are split into shards
+    that are binned in a pool of processes and stitched back into the same output.
+    The spike arrays are shared with the workers through shared memory (or reopened from file
+    if they are memmaps) rather than pickled. Small inputs are binned serially.
+
+    :param spike_times: spike times (in seconds), or a SpikeTable
+    :type spike_times: array-like
+    :param spike_clusters: cluster ids corresponding to each event in `spikes`, ignored for a SpikeTable
+    :type spike_clusters: array-like
+    :param cluster_ids: subset of cluster ids for calculating rasters
+    :type cluster_ids: array-like
+    :param align_times: times (in seconds) to align rasters to
+    :type align_times: array-like
+    :param n_workers: number of processes, defaults to the number of cores
+    :type n_workers: int
+    :param shard_by: 'clusters' or 'events', the dimension split between workers
+    :type shard_by: str
+    :param kwargs: tscale, pre_time, post_time, bin_size, smoothing, return_fr,
+        baseline_subtract, engine and dtype, as in get_binned_rasters
+
+    :return: rasters
+    :rtype: rasters: Bunch({'rasters': binned_spikes_, 'tscale': ts, 'cscale': ids})
+    """
+    if shard_by not in ["clusters", "events"]:
+        raise ValueError(f"shard_by must be 'clusters' or 'events', got {shard_by}")
+    spike_times, spike_clusters = _spike_arrays(spike_times, spike_clusters)
+    align_times = np.asarray(align_times)
+    ids = np.unique(cluster_ids)
+    n_workers = n_workers or os.cpu_count() or 1
+    if n_workers < 2 or align_times.size * ids.size < PARALLEL_MIN_SIZE:
+        return get_binned_rasters(spike_times, spike_clusters, cluster_ids, align_times, **kwargs)
+
+    if shard_by == "clusters":
+        shards = [(sh, np.arange(align_times.size)) for sh in np.array_split(ids, n_workers)]
     else:
-        binned_spikes_ = np.copy(binned_spikes)
-
-    if return_fr:
-        # to account also for uneven binsizes
-        FRbins = np.repeat(
-            np.repeat(bin_sizes[np.newaxis, np.newaxis, :], len(cluster_ids), axis=1),
-            len(align_times),
-            axis=0,
+        # events close in time are binned by the same worker
+        order = np.argsort(align_times, kind="stable")
+        shards = [(ids, iev) for iev in np.array_split(order, n_workers)]
+    shards = [(sh, iev) for sh, iev in shards if sh.size > 0 and iev.size > 0]
+
+    times_spec, shm_times = _share_array(spike_times)
+    clusters_spec, shm_clusters = _share_array(spike_clusters)
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [
+                executor.submit(
+                    _binned_rasters_worker, times_spec, clusters_spec, sh, align_times[iev], kwargs
+                )
+                for sh, iev in shards
+            ]
+            # stitch the shards back in place as they come
+            out = None
+            for (sh, iev), future in zip(shards, futures):
+                rasters = future.result()
+                if out is None:
+                    shape = (align_times.size, ids.size, rasters.tscale.size)
+                    out = np.empty(shape, dtype=rasters.rasters.dtype)
+                    ts = rasters.tscale
+                icl = np.searchsorted(ids, sh)
+                out[iev[:, np.newaxis], icl] = rasters.rasters
+    finally:
+        for shm in (shm_times, shm_clusters):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    return Bunch({"rasters": out, "tscale": ts, "cscale": ids})
+
+
+class PSTHAccumulator:
+    """
+    Online version of get_binned_rasters for data arriving in chunks, e.g. during acquisition.
+    Spike chunks and align times are added as they arrive and the peri-event spike counts are
+    updated in place: new spikes are only binned into the events whose windows are still open,
+    and new events are binned against a buffer of the recent spikes, so that the cost of an update
+    only depends on the new data. A snapshot gives the same output as get_binned_rasters called
+    on all the data received so far.
+
+    acc = PSTHAccumulator(cluster_ids, pre_time=0.2, post_time=0.5)
+    for spike_times, spike_clusters, align_times in stream:
+        acc.add_spikes(spike_times, spike_clusters)
+        acc.add_events(align_times)
+    rasters = acc.snapshot()
+    """
+
+    def __init__(
+        self,
+        cluster_ids,
+        tscale=[None],
+        pre_time=0.2,
+        post_time=0.5,
+        bin_size=0.025,
+        smoothing=0.025,
+        return_fr=True,
+        baseline_subtract=False,
+        max_event_delay=10.0,
+        dtype=np.float64,
+    ):
+        """
+        :param cluster_ids: cluster ids for calculating rasters
+        :param tscale, pre_time, post_time, bin_size, smoothing, return_fr, baseline_subtract:
+            as in get_binned_rasters
+        :param max_event_delay: maximum time (in seconds) between an align time and the latest
+            spike received when the align time is added; sets how much spike history is buffered
+        :param dtype: dtype of the counts and of the snapshots
+        """
+        self.tscale, self.n_bins, n_offset, smoothing, _ = _raster_time_scale(
+            tscale, pre_time, post_time, bin_size, smoothing
+        )
+        self.ts, self._finalise = _raster_finalisation(
+            self.tscale, self.n_bins, n_offset, bin_size, smoothing, return_fr, baseline_subtract
         )
-        binned_spikes_ /= FRbins
-        # binned_spikes_ /= bin_size
+        self.ids = np.unique(cluster_ids)
+        self.dtype = dtype
+        # spikes older than this duration before the latest spike are dropped from the buffer
+        self.buffer_duration = max_event_delay - min(self.tscale[0], 0)
+        self._buffer_times = np.zeros(0)
+        self._buffer_clusters = np.zeros(0, dtype=self.ids.dtype)
+        self._buffer_start = -np.inf  # spikes before this time may have been dropped
+        self._t_last = -np.inf  # latest spike time received
+        self._align_times = np.zeros(0)
+        self._counts = np.zeros((0, self.ids.size, self.tscale.size), dtype=dtype)
+        self._n_events = 0
+        self._open = np.zeros(0, dtype=np.int64)  # events whose window may still get spikes
 
-    if smoothing > 0:
-        binned_spikes_ = binned_spikes_[:, :, n_offset:-n_offset]
-        tscale = tscale[n_offset:-n_offset]
+    @property
+    def align_times(self):
+        return self._align_times[: self._n_events]
 
-    # package output
-    tscale = (tscale[:-1] + tscale[1:]) / 2
+    def add_spikes(self, spike_times, spike_clusters):
+        """
+        Adds a chunk of spikes, later than all the spikes added before
+        :param spike_times: spike times (in seconds), or a SpikeTable
+        :param spike_clusters: cluster ids corresponding to each spike, ignored for a SpikeTable
+        """
+        spike_times, spike_clusters = _spike_arrays(spike_times, spike_clusters)
+        spike_times, spike_clusters = np.asarray(spike_times), np.asarray(spike_clusters)
+        if spike_times.size == 0:
+            return
+        if np.any(np.diff(spike_times) < 0):
+            isort = np.argsort(spike_times, kind="stable")
+            spike_times, spike_clusters = spike_times[isort], spike_clusters[isort]
+        if spike_times[0] < self._t_last:
+            raise ValueError("spike chunks must be added in time order")
+        idxs = np.isin(spike_clusters, self.ids)
+        spike_times, spike_clusters = spike_times[idxs], spike_clusters[idxs]
+        self._t_last = max(self._t_last, spike_times[-1]) if spike_times.size else self._t_last
 
-    if baseline_subtract:
-        # subtract the mean baseline (i.e. the mean before 0 on the tscale)
-        baseline = (binned_spikes_[:, :, tscale < 0]).mean(axis=2)
-        baseline = np.tile(baseline[:, :, np.newaxis], binned_spikes_.shape[2])
-        binned_spikes_ = binned_spikes_ - baseline
+        # bin the new spikes into the open events, then close the events that are over
+        if self._open.size > 0 and spike_times.size > 0:
+            self._counts[self._open] += _bin_rasters_vectorized(
+                spike_times,
+                spike_clusters,
+                self.ids,
+                self._align_times[self._open],
+                self.tscale,
+                dtype=self.dtype,
+            )
+        self._open = self._open[self._align_times[self._open] + self.tscale[-1] >= self._t_last]
 
-    rasters = Bunch({"rasters": binned_spikes_, "tscale": tscale, "cscale": ids})
+        # keep the recent spikes for events that are still to be added
+        self._buffer_start = max(self._buffer_start, self._t_last - self.buffer_duration)
+        keep = np.searchsorted(self._buffer_times, self._buffer_start, side="left")
+        ikeep = np.searchsorted(spike_times, self._buffer_start, side="left")
+        self._buffer_times = np.concatenate((self._buffer_times[keep:], spike_times[ikeep:]))
+        self._buffer_clusters = np.concatenate(
+            (self._buffer_clusters[keep:], spike_clusters[ikeep:])
+        )
 
-    return rasters
+    def add_events(self, align_times):
+        """
+        Adds align times, their windows are filled with the spikes already received and the
+        spikes to come
+        :param align_times: times (in seconds) to align rasters to
+        """
+        align_times = np.atleast_1d(np.asarray(align_times, dtype=np.float64))
+        if align_times.size == 0:
+            return
+        if np.any(align_times + self.tscale[0] < self._buffer_start):
+            raise ValueError(
+                "align times are older than the spike buffer, increase max_event_delay"
+            )
+        counts = _bin_rasters_vectorized(
+            self._buffer_times,
+            self._buffer_clusters,
+            self.ids,
+            align_times,
+            self.tscale,
+            dtype=self.dtype,
+        )
+        # grow the storage geometrically so that appending events is amortised
+        n = self._n_events + align_times.size
+        if n > self._align_times.size:
+            capacity = max(n, 2 * self._align_times.size)
+            self._align_times = np.resize(self._align_times, capacity)
+            counts_ = np.zeros((capacity,) + self._counts.shape[1:], dtype=self.dtype)
+            counts_[: self._n_events] = self._counts[: self._n_events]
+            self._counts = counts_
+        self._align_times[self._n_events : n] = align_times
+        self._counts[self._n_events : n] = counts
+        new = np.arange(self._n_events, n)
+        self._open = np.concatenate(
+            (self._open, new[align_times + self.tscale[-1] >= self._t_last])
+        )
+        self._n_events = n
 
-def bin_spikes_pos_and_time(spikes, depth_corr_window_spacing=40, spike_binning_t=0.01):
+    def snapshot(self):
+        """
+        Rasters of all the events added so far, as returned by get_binned_rasters
+        :return: Bunch({'rasters', 'tscale', 'cscale'})
+        """
+        rasters = self._finalise(self._counts[: self._n_events].copy())
+        return Bunch({"rasters": np.ascontiguousarray(rasters), "tscale": self.ts, "cscale": self.ids})
 
-    depth_corr_window = 0  # MUA window in microns
+
+def correlograms(
+    spike_times,
+    spike_clusters,
+    cluster_ids=None,
+    bin_size=0.001,
+    window_size=0.05,
+    pairs=None,
+    chunk_size=None,
+):
+    """
+    Cross-correlograms between clusters, computed from the spike times with a sliding window over
+    the time-sorted spikes: each spike is compared with its successors until the lag exceeds half
+    the window, so no dense binned spike trains are built.
+
+    :param spike_times: spike times (in seconds), sorted, or a SpikeTable. Can be memory-mapped.
+    :param spike_clusters: cluster ids corresponding to each spike, ignored for a SpikeTable
+    :param cluster_ids: (optional) clusters to correlate, defaults to all the clusters
+    :param bin_size: lag bin size (in seconds)
+    :param window_size: total width of the correlograms (in seconds)
+    :param pairs: (optional) [n_pairs, 2] cluster ids of the pairs to correlate, defaults to all pairs.
+        The ids must be in cscale (ValueError otherwise), repeated pairs get the same counts
+    :param chunk_size: (optional) number of spikes processed at once, bounds the memory for very long
+        recordings. Defaults to all the spikes at once.
+    :return: Bunch({'ccg': [n_clusters, n_clusters, n_lags] counts, 'lags': [n_lags] lag bin centres,
+        'cscale': cluster ids}). ccg[i, j, k] counts the pairs of spikes of cluster cscale[i] at t and of
+        cluster cscale[j] at t + lags[k]. With pairs, ccg is [n_pairs, n_lags] and the Bunch also
+        holds 'pairs'.
+    """
+    spike_times, spike_clusters = _spike_arrays(spike_times, spike_clusters)
+    ids = np.unique(spike_clusters) if cluster_ids is None else np.unique(cluster_ids)
+    n_ids = ids.size
+    n_half = int(np.round(window_size / 2 / bin_size))
+    n_lags = 2 * n_half + 1
+    max_lag = (n_half + 0.5) * bin_size
+
+    if pairs is None:
+        lut = None
+        ccg = np.zeros(n_ids * n_ids * n_lags, dtype=np.int64)
+    else:
+        pairs = np.atleast_2d(pairs)
+        unknown = np.setdiff1d(pairs, ids)
+        if unknown.size:
+            raise ValueError(f"pairs hold cluster ids that are not in cscale: {unknown}")
+        ia, ib = np.searchsorted(ids, pairs[:, 0]), np.searchsorted(ids, pairs[:, 1])
+        # repeated pairs are counted once, and get the same row in the output
+        upairs, pair_rows = np.unique(ia * n_ids + ib, return_inverse=True)
+        # lookup table from the (cluster, cluster) index to the row of the unique pair
+        lut = np.full(n_ids * n_ids, -1, dtype=np.int64)
+        lut[upairs] = np.arange(upairs.size)
+        ccg = np.zeros(upairs.size * n_lags, dtype=np.int64)
+
+    def _accumulate(rows, lags):
+        if lut is not None:
+            rows = lut[rows]
+            lags = lags[rows >= 0]
+            rows = rows[rows >= 0]
+        ind, counts = np.unique(rows * n_lags + lags, return_counts=True)
+        ccg[ind] += counts
+
+    n_spikes = len(spike_times)
+    chunk_size = chunk_size or max(n_spikes, 1)
+    for first in range(0, n_spikes, chunk_size):
+        last = min(first + chunk_size, n_spikes)
+        # the spikes of the chunk are compared with successors up to max_lag after the chunk end
+        end = np.searchsorted(spike_times, spike_times[last - 1] + max_lag, side="right")
+        t = np.asarray(spike_times[first:end])
+        c = np.asarray(spike_clusters[first:end])
+        keep = np.isin(c, ids)
+        n_own = np.sum(keep[: last - first])
+        t, c = t[keep], np.searchsorted(ids, c[keep])
+
+        active = np.arange(n_own)
+        shift = 1
+        while active.size > 0:
+            active = active[active + shift < t.size]
+            dt = t[active + shift] - t[active]
+            # the spikes are sorted: once out of the window, all the next successors are too
+            active = active[dt < max_lag]
+            lag = np.floor(dt[dt < max_lag] / bin_size + 0.5).astype(np.int64)
+            ci, cj = c[active], c[active + shift]
+            # each pair counts once at +lag for (ci, cj) and once at -lag for (cj, ci)
+            _accumulate(np.r_[ci * n_ids + cj, cj * n_ids + ci], np.r_[n_half + lag, n_half - lag])
+            shift += 1
+
+    lags = np.arange(-n_half, n_half + 1) * bin_size
+    if pairs is None:
+        return Bunch({"ccg": ccg.reshape(n_ids, n_ids, n_lags), "lags": lags, "cscale": ids})
+    ccg = ccg.reshape(upairs.size, n_lags)[pair_rows.ravel()]
+    return Bunch({"ccg": ccg, "lags": lags, "cscale": ids, "pairs": pairs})
+
+
+def _pos_and_time_scales(spikes, depth_corr_window_spacing, spike_binning_t):
     max_depths = 5760
 
     depth_corr_bins = np.arange(
@@ -279,22 +1091,56 @@ def bin_spikes_pos_and_time(spikes, depth_corr_window_spacing=40, spike_binning_
         np.nanmax(spikes.times) + spike_binning_t,
         spike_binning_t,
     )
-    binned_spikes_depth = np.zeros(
-        (shank_bins.size, depth_corr_bins.size, spike_binning_t_edges.size - 1)
-    )
+    return shank_bins, depth_corr_bins, spike_binning_t_edges
 
-    for i in shank_bins:
-        for j in range(depth_corr_bins.size):
-            curr_depth_templates_idx = np.where(
-                (spikes._av_shankIDs == i)
-                & (spikes.depths >= depth_corr_bins[j])
-                & (spikes.depths < depth_corr_bins[j] + depth_corr_window_spacing)
-            )[0]
 
-            N = np.histogram(
-                spikes.times[curr_depth_templates_idx], spike_binning_t_edges
-            )
-            binned_spikes_depth[i, j, :] = N[0]
+def _bincount_pos_and_time(
+    times, shanks, depths, shank_bins, depth_bins, depth_spacing, t_edges, right_closed=True
+):
+    """
+    Counts spikes per (shank, depth, time) bin with a single bincount
+    :param right_closed: the last time bin includes the last edge, as for np.histogram
+    :return: counts [n_shanks, n_depths, t_edges.size - 1]
+    """
+    n_shanks, n_depths, n_t = shank_bins.size, depth_bins.size, t_edges.size - 1
+    # shank index: exact match to one of the shank bins
+    ishank = np.minimum(np.searchsorted(shank_bins, shanks), n_shanks - 1)
+    valid = shank_bins[ishank] == shanks
+    # depth index: depth_bins[j] <= depth < depth_bins[j] + depth_spacing
+    idepth = np.searchsorted(depth_bins, depths, side="right") - 1
+    valid &= idepth >= 0
+    valid &= depths < depth_bins[np.maximum(idepth, 0)] + depth_spacing
+    # time index: t_edges[k] <= time < t_edges[k + 1]
+    it = np.searchsorted(t_edges, times, side="right") - 1
+    if right_closed:
+        it[times == t_edges[-1]] = n_t - 1
+    valid &= np.bitwise_and(it >= 0, it < n_t)
+
+    ind3d = (ishank[valid] * n_depths + idepth[valid]) * n_t + it[valid]
+    r = np.bincount(ind3d, minlength=n_shanks * n_depths * n_t)
+    return r.reshape(n_shanks, n_depths, n_t).astype(np.float64)
+
+
+def bin_spikes_pos_and_time(spikes, depth_corr_window_spacing=40, spike_binning_t=0.01):
+    """
+    Bins spikes per shank, depth and time, with one pass over the spikes
+    :param spikes: Bunch (or SpikeTable) with times, depths and _av_shankIDs
+    :param depth_corr_window_spacing: depth bin size (um)
+    :param spike_binning_t: time bin size (s)
+    :return: Bunch({'array': [n_shanks, n_depths, n_times], 'xposscale', 'depthscale', 'tscale': time bin edges})
+    """
+    shank_bins, depth_corr_bins, spike_binning_t_edges = _pos_and_time_scales(
+        spikes, depth_corr_window_spacing, spike_binning_t
+    )
+    binned_spikes_depth = _bincount_pos_and_time(
+        spikes.times,
+        spikes._av_shankIDs,
+        spikes.depths,
+        shank_bins,
+        depth_corr_bins,
+        depth_corr_window_spacing,
+        spike_binning_t_edges,
+    )
 
     return Bunch(
         {
@@ -305,22 +1151,95 @@ def bin_spikes_pos_and_time(spikes, depth_corr_window_spacing=40, spike_binning_
         }
     )
 
-def bin_mua_per_depth(spikes, depth_spacing=40, depth_min=0, depth_max=5760):
 
+def iter_spikes_pos_and_time(
+    spikes, depth_corr_window_spacing=40, spike_binning_t=0.01, chunk_duration=600
+):
+    """
+    Chunked-over-time version of bin_spikes_pos_and_time, so that long recordings can be
+    binned finely without holding the whole array in memory. Concatenating the chunk arrays
+    along the time axis gives the output of bin_spikes_pos_and_time.
+    :param spikes: Bunch (or SpikeTable) with times, depths and _av_shankIDs
+    :param depth_corr_window_spacing: depth bin size (um)
+    :param spike_binning_t: time bin size (s)
+    :param chunk_duration: approximate duration (s) of each chunk
+    :return: generator of Bunch({'array', 'xposscale', 'depthscale', 'tscale'}), tscale holding
+        the time bin edges of the chunk
+    """
+    shank_bins, depth_corr_bins, t_edges = _pos_and_time_scales(
+        spikes, depth_corr_window_spacing, spike_binning_t
+    )
+    n_t = t_edges.size - 1
+    bins_per_chunk = max(1, int(np.round(chunk_duration / spike_binning_t)))
+    is_sorted = isinstance(spikes, SpikeTable) or not np.any(np.diff(spikes.times) < 0)
+    for first in range(0, n_t, bins_per_chunk):
+        last = min(first + bins_per_chunk, n_t)
+        edges = t_edges[first : last + 1]
+        if is_sorted:
+            isp = slice(
+                np.searchsorted(spikes.times, edges[0], side="left"),
+                np.searchsorted(spikes.times, edges[-1], side="right"),
+            )
+        else:
+            isp = np.bitwise_and(spikes.times >= edges[0], spikes.times <= edges[-1])
+        binned_spikes_depth = _bincount_pos_and_time(
+            spikes.times[isp],
+            spikes._av_shankIDs[isp],
+            spikes.depths[isp],
+            shank_bins,
+            depth_corr_bins,
+            depth_corr_window_spacing,
+            edges,
+            # spikes on a chunk boundary belong to the next chunk
+            right_closed=last == n_t,
+        )
+        yield Bunch(
+            {
+                "array": binned_spikes_depth,
+                "xposscale": shank_bins,
+                "depthscale": depth_corr_bins,
+                "tscale": edges,
+            }
+        )
+
+def bin_mua_per_depth(spikes, depth_spacing=40, depth_min=0, depth_max=5760, as_strings=True):
+    """
+    Assigns each spike to a depth bin and to a shank-depth group
+    :param spikes: Bunch with depths and _av_shankIDs
+    :param depth_spacing: depth bin size (um)
+    :param depth_min: first depth bin edge (um)
+    :param depth_max: depth bin edges stop below this value (um)
+    :param as_strings: (optional) defaults to True, also return the "shank-depth" label of every
+        spike in shank_depth_ids. The integer keys are enough for sorting and grouping.
+    :return: Bunch with depth_ids, depth_bin_edges, shank_depth_keys (integer key per spike),
+        shank_depth_labels (lookup table: shank_depth_labels[key] is the label of key),
+        shank_scale (shank of each key group) and shank_depth_ids if requested
+    """
     depth_bin_edges = np.arange(depth_min, depth_max, depth_spacing)
     depth_ids = np.digitize(spikes.depths, bins=depth_bin_edges)
-    # shank*depth ID strings so that units can be sorted based on that if necessary
-    shank_depth_ids = [
-        "%.0d-%.0d" % (shank, depth_bin_edges[d_id - 1])
-        for shank, d_id in zip(spikes._av_shankIDs, depth_ids)
-    ]
+    # shank*depth integer keys so that units can be sorted based on that if necessary
+    shank_scale, ishank = np.unique(spikes._av_shankIDs, return_inverse=True)
+    n_depth_ids = depth_bin_edges.size + 1
+    shank_depth_keys = ishank.ravel() * n_depth_ids + depth_ids
+    # the labels are only formatted once per key
+    shank_depth_labels = np.array(
+        [
+            "%.0d-%.0d" % (shank, depth_bin_edges[d_id - 1])
+            for shank in shank_scale
+            for d_id in range(n_depth_ids)
+        ]
+    )
 
     spikes_depthID = Bunch(
         {
             "depth_ids": depth_ids,
-            "shank_depth_ids": np.array(shank_depth_ids),
+            "shank_depth_keys": shank_depth_keys,
+            "shank_depth_labels": shank_depth_labels,
+            "shank_scale": shank_scale,
             "depth_bin_edges": depth_bin_edges,
         }
     )
+    if as_strings:
+        spikes_depthID["shank_depth_ids"] = shank_depth_labels[shank_depth_keys]
     # digitise depth bins
     return spikes_depthID
@@ -0,0 +1,173 @@
+# persistent memoization of binning results (e.g. get_binned_rasters, bincount2D) on local disk
+# results are keyed on a digest of the content of the input arrays and of the parameters
+
+import functools
+import hashlib
+import inspect
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from .io import MANIFEST_FILE, Bunch, LazyBunch
+
+
+def _update_digest(h, value):
+    """
+    Feeds a function argument to a hashlib object: arrays by content, containers recursively,
+    anything else by its repr
+    """
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        h.update(f"ndarray{value.dtype.str}{value.shape}".encode())
+        h.update(memoryview(value.reshape(-1)).cast("B"))
+    elif isinstance(value, (list, tuple)):
+        h.update(f"{type(value).__name__}{len(value)}".encode())
+        for v in value:
+            _update_digest(h, v)
+    elif isinstance(value, dict):
+        h.update(f"dict{len(value)}".encode())
+        for k in sorted(value):
+            h.update(repr(k).encode())
+            _update_digest(h, value[k])
+    else:
+        h.update(repr(value).encode())
+
+
+class ArrayCache:
+    """
+    Content-addressed on-disk cache for functions returning arrays, a Bunch of arrays or a tuple
+    of arrays, such as binning.get_binned_rasters or binning.bincount2D.
+    Each result is stored as a Bunch folder (see Bunch.save_dir) and memory-mapped (read-only) on reload.
+    When the cache grows above max_bytes, the least recently used results are evicted.
+
+    cache = ArrayCache('/data/cache/rasters', max_bytes=20 * 2 ** 30)
+    rasters = cache(get_binned_rasters, spike_times, spike_clusters, cluster_ids, align_times)
+    # or
+    get_binned_rasters_cached = cache.memoize(get_binned_rasters)
+    rasters = get_binned_rasters_cached(spike_times, spike_clusters, cluster_ids, align_times, bypass=True)
+    """
+
+    def __init__(self, cache_dir, max_bytes=10 * 2 ** 30, enabled=True):
+        """
+        :param cache_dir: folder holding the cached results, created if needed
+        :param max_bytes: size above which the least recently used results are evicted
+        :param enabled: (True) if False every call is computed and nothing is stored
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+
+    def key(self, func, *args, **kwargs):
+        """
+        Digest of the function name and of its arguments, bound to the function signature so that
+        positional, keyword and default arguments give the same key
+        :return: str
+        """
+        bound = inspect.signature(func).bind(*args, **kwargs)
+        bound.apply_defaults()
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{func.__module__}.{func.__qualname__}".encode())
+        _update_digest(h, dict(bound.arguments))
+        return h.hexdigest()
+
+    def __call__(self, func, *args, bypass=False, **kwargs):
+        """
+        Returns func(*args, **kwargs), from the cache if it was computed before
+        :param bypass: (False) if True, compute the result without reading or writing the cache
+        """
+        if bypass or not self.enabled:
+            return func(*args, **kwargs)
+        key = self.key(func, *args, **kwargs)
+        result = self._load(key)
+        if result is None:
+            result = func(*args, **kwargs)
+            if self._store(key, result):
+                self._evict()
+        return result
+
+    def memoize(self, func):
+        """
+        Wraps func so that its calls go through the cache, the wrapper takes an extra bypass argument
+        """
+
+        @functools.wraps(func)
+        def wrapper(*args, bypass=False, **kwargs):
+            return self(func, *args, bypass=bypass, **kwargs)
+
+        return wrapper
+
+    @property
+    def size(self):
+        """Total size of the cached results in bytes"""
+        return sum(self._entry_size(d) for d in self._entries())
+
+    def clear(self):
+        """Removes all cached results"""
+        for d in self._entries():
+            shutil.rmtree(d, ignore_errors=True)
+
+    def _entries(self):
+        if not self.cache_dir.exists():
+            return []
+        return [d for d in self.cache_dir.iterdir() if d.joinpath(MANIFEST_FILE).exists()]
+
+    @staticmethod
+    def _entry_size(entry):
+        return sum(f.stat().st_size for f in entry.iterdir())
+
+    def _load(self, key):
+        entry = self.cache_dir.joinpath(key)
+        manifest_file = entry.joinpath(MANIFEST_FILE)
+        if not manifest_file.exists():
+            return None
+        rtype = json.loads(manifest_file.read_text())["metadata"]["type"]
+        # the manifest modification time records the last access for eviction
+        os.utime(manifest_file)
+        # all arrays are memory-mapped now, so that they stay readable if the entry is evicted
+        result = LazyBunch.load_dir(entry).copy()
+        if rtype == "bunch":
+            return result
+        if rtype == "tuple":
+            return tuple(result.values())
+        return result["0"]
+
+    def _store(self, key, result):
+        """
+        Writes the result, returns False if it cannot be stored as .npy files
+        """
+        if isinstance(result, dict):
+            rtype, bunch = "bunch", Bunch(result)
+        elif isinstance(result, tuple):
+            rtype, bunch = "tuple", Bunch({str(i): it for i, it in enumerate(result)})
+        else:
+            rtype, bunch = "array", Bunch({"0": result})
+        # only arrays that can be memory-mapped back are stored (e.g. not sparse matrices)
+        items = [None if it is None else np.asanyarray(it) for it in bunch.values()]
+        if any(isinstance(it, np.matrix) or (it is not None and it.dtype.hasobject) for it in items):
+            return False
+
+        # write in a temporary folder renamed at the end, so that readers never see partial results
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = self.cache_dir.joinpath(f".{key}.{os.getpid()}.tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        bunch.save_dir(tmp, metadata={"type": rtype})
+        try:
+            tmp.rename(self.cache_dir.joinpath(key))
+        except OSError:
+            # the same result was stored concurrently
+            shutil.rmtree(tmp, ignore_errors=True)
+        return True
+
+    def _evict(self):
+        """Removes the least recently used results until the cache fits in max_bytes"""
+        entries = self._entries()
+        sizes = {d: self._entry_size(d) for d in entries}
+        total = sum(sizes.values())
+        for d in sorted(entries, key=lambda d: d.joinpath(MANIFEST_FILE).stat().st_mtime):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(d, ignore_errors=True)
+            total -= sizes[d]
@@ -18,7 +18,7 @@ import nrrd
 
 import floras_helpers.hist.hashfile as hashfile
 
-from floras_helpers.numerical import ismember
+from floras_helpers.numerical import ismember, MemberIndex
 from floras_helpers.hist.regions import BrainRegions
 
 _logger = logging.getLogger(__name__)
@@ -931,13 +931,15 @@ class AllenAtlas(BrainAtlas):
                 lateral[int(np.floor(ibregma[0]))] = 1
                 lateral = np.sign(np.cumsum(lateral)[np.newaxis, :, np.newaxis] - 0.5)
                 label = label * lateral.astype(np.int32)
+                # the region ids index is built once for the whole volume
+                id_index = MemberIndex(regions.id)
                 # the 10 um atlas is too big to fit in memory so work by chunks instead
                 if res_um == 10:
                     first, ncols = (0, 10)
                     while True:
                         last = np.minimum(first + ncols, label.shape[-1])
                         _logger.info(f"Computing... {last} on {label.shape[-1]}")
-                        _, im = ismember(label[:, :, first:last], regions.id)
+                        _, im = ismember(label[:, :, first:last], id_index)
                         label[:, :, first:last] = np.reshape(im, label[:, :, first:last].shape)
                         if last == label.shape[-1]:
                             break
@@ -945,7 +947,7 @@ class AllenAtlas(BrainAtlas):
                     label = label.astype(dtype=np.uint16)
                     _logger.info("Saving npz, this can take a long time")
                 else:
-                    _, im = ismember(label, regions.id)
+                    _, im = ismember(label, id_index)
                     label = np.reshape(im.astype(np.uint16), label.shape)
                 np.savez_compressed(file_label_remap, label)
                 _logger.info(f"Cached remapping file {file_label_remap} ...")
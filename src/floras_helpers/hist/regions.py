@@ -5,7 +5,7 @@ import numpy as np
 import pandas as pd
 
 from floras_helpers.io import Bunch
-from floras_helpers.numerical import ismember
+from floras_helpers.numerical import ismember, MemberIndex
 
 _logger = logging.getLogger(__name__)
 # 'Beryl' is the name given to an atlas containing a subset of the most relevant allen annotations
@@ -40,6 +40,21 @@ class _BrainRegions:
         # Then right hemisphere
         orders[2::2] = np.arange(self.n_lr) + 1
 
+    def _member_index(self, source_map=None):
+        """
+        MemberIndex over the region ids, or over the region ids of a mapping, built once and
+        reused by the ismember queries against them. It is rebuilt if the ids or mapping are replaced
+        :param source_map: mapping name, None for the region ids
+        :return: MemberIndex
+        """
+        sources = (self.id,) if source_map is None else (self.id, self.mappings[source_map])
+        cache = self.__dict__.setdefault('_member_indices', {})
+        cached = cache.get(source_map)
+        if cached is None or any(a is not b for a, b in zip(cached[0], sources)):
+            b = self.id if source_map is None else self.id[self.mappings[source_map]]
+            cached = cache[source_map] = (sources, MemberIndex(b))
+        return cached[1]
+
     def get(self, ids) -> Bunch:
         """
         Get a bunch of the name/id
@@ -63,11 +78,20 @@ class _BrainRegions:
         """
         indices = ismember(self.id, ids)[0]
         count = np.sum(indices)
+        # locate the ids and parents once in the ids index: each iteration is then a lookup
+        # selected flags the first occurrence of the ids in the branch
+        id_index = self._member_index()
+        iid = id_index.locate(self.id)
+        ipar = id_index.locate(self.parent)
+        has_parent = ipar >= 0
+        selected = np.zeros(self.id.size, bool)
         while True:
             if direction == 'down':
-                indices |= ismember(self.parent, self.id[indices])[0]
+                selected[iid[indices]] = True
+                indices |= has_parent & selected[ipar]
             elif direction == 'up':
-                indices |= ismember(self.id, self.parent[indices])[0]
+                selected[ipar[indices & has_parent]] = True
+                indices |= selected[iid]
             else:
                 raise ValueError("direction should be either 'up' or 'down'")
             if count == np.sum(indices):  # last iteration didn't find any match
@@ -132,7 +156,7 @@ class _BrainRegions:
         :return:
         """
         user_aids = self.parse_acronyms_argument(acronyms)
-        _, user_indices = ismember(user_aids, self.id)
+        _, user_indices = ismember(user_aids, self._member_index())
         self.compute_hierarchy()
         ia, ib = ismember(self.hierarchy, user_indices)
         v = np.zeros_like(ia, dtype=np.float64) * np.NaN
@@ -168,7 +192,7 @@ class _BrainRegions:
         mapind[0] = I_VOID  # void stays void
         # to delateralize the regions, assign the positive index to all mapind elements
         if lateralize is False:
-            _, iregion = ismember(np.abs(self.id), self.id)
+            _, iregion = ismember(np.abs(self.id), self._member_index())
             mapind = mapind[iregion]
         return mapind
 
@@ -471,7 +495,7 @@ class BrainRegions(_BrainRegions):
         n_regions = self.id.size
         # creates the parent index. Void and root are omitted from intersection
         # as they figure as NaN
-        pmask, i_p = ismember(self.parent, self.id)
+        pmask, i_p = ismember(self.parent, self._member_index())
         self.iparent = np.arange(n_regions)
         self.iparent[pmask] = i_p
         # the last level of the hierarchy is the actual mapping, then going up level per level
@@ -493,7 +517,7 @@ class BrainRegions(_BrainRegions):
         :param target_map: map name onto which to map
         :return:
         """
-        _, inds = ismember(region_ids, self.id[self.mappings[source_map]])
+        _, inds = ismember(region_ids, self._member_index(source_map))
         return self.id[self.mappings[target_map][inds]]
 
 
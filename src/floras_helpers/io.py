@@ -1,8 +1,13 @@
 from pathlib import Path 
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import json
 from datetime import datetime
 import re
+import zlib
+
+# manifest of the folders written by Bunch.save_dir
+MANIFEST_FILE = 'manifest.json'
 
 
 class Bunch(dict):
@@ -20,6 +25,7 @@ class Bunch(dict):
     def save(self, npz_file, compress=False):
         """
         Saves a npz file containing the arrays of the bunch.
+        For large arrays, see save_dir which compresses with multiple threads.
 
         :param npz_file: output file
         :param compress: bool (False) use compression
@@ -33,15 +39,270 @@ class Bunch(dict):
     @staticmethod
     def load(npz_file):
         """
-        Loads a npz file containing the arrays of the bunch.
+        Loads a npz file containing the arrays of the bunch, or a folder written by
+        Bunch.save_dir, whose arrays are memory-mapped on first access.
 
-        :param npz_file: output file
-        :return: Bunch
+        :param npz_file: output file, or folder
+        :return: Bunch, or LazyBunch for a folder
         """
         if not Path(npz_file).exists():
             raise FileNotFoundError(f"{npz_file}")
+        if Path(npz_file).is_dir():
+            return LazyBunch.load_dir(npz_file)
         return Bunch(np.load(npz_file))
-        
+
+    def save_dir(self, folder, metadata=None, compress=False, n_threads=None, chunk_size=2 ** 22):
+        """
+        Saves the arrays of the bunch in a folder, one .npy file per key plus a manifest,
+        so that they can be memory-mapped on load (see LazyBunch). None values are kept.
+        With compression, each array is split in chunks deflated by a pool of threads in a .zlib
+        file, the chunk sizes are stored in the manifest so that they are inflated in parallel on load.
+
+        :param folder: output folder, created if needed
+        :param metadata: dictionary of json serializable values stored in the manifest
+        :param compress: bool (False) use compression, or zlib compression level (1-9)
+        :param n_threads: number of compression threads (default: number of cpus)
+        :param chunk_size: size of the compressed chunks in bytes (before compression)
+        :return: None
+        """
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        keys, files, names = list(self.keys()), [], set()
+        level = -1 if compress is True else int(compress)
+        with ThreadPoolExecutor(n_threads) as pool:
+            for i, k in enumerate(keys):
+                if self[k] is None:
+                    files.append(None)
+                    continue
+                v = np.asanyarray(self[k])
+                if v.dtype.hasobject:
+                    raise ValueError(f"{k}: arrays of objects can't be memory-mapped")
+                # keys that are not valid file names are saved by position, and names are made
+                # unique (case-insensitive) so that two keys never share a file
+                name = str(k) if re.fullmatch(r'[\w\-.]+', str(k)) else f"_key{i}"
+                while name.lower() in names:
+                    name += '_'
+                names.add(name.lower())
+                if compress:
+                    files.append(_save_compressed(folder.joinpath(f"{name}.zlib"), v, pool,
+                                                  level, chunk_size))
+                else:
+                    files.append(f"{name}.npy")
+                    np.save(folder.joinpath(files[-1]), v)
+        manifest = {'format': 'bunch', 'version': 1, 'keys': keys, 'files': files,
+                    'metadata': metadata or {}}
+        folder.joinpath(MANIFEST_FILE).write_text(json.dumps(manifest))
+
+
+class _LazyArray:
+    """Array file of a LazyBunch, memory-mapped when first accessed"""
+
+    def __init__(self, file):
+        self.file = Path(file)
+
+    def load(self):
+        return np.load(self.file, mmap_mode='r')
+
+    def __repr__(self):
+        return f"<not loaded: {self.file.name}>"
+
+
+def _save_compressed(file, array, pool, level, chunk_size):
+    """
+    Writes the chunks of the array deflated in the thread pool (zlib releases the GIL)
+    :return: manifest entry of the array
+    """
+    data = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+    chunks = pool.map(lambda i: zlib.compress(data[i:i + chunk_size], level),
+                      range(0, data.size, chunk_size))
+    sizes = []
+    with open(file, 'wb') as fid:
+        for chunk in chunks:
+            fid.write(chunk)
+            sizes.append(len(chunk))
+    return {'file': file.name, 'descr': np.lib.format.dtype_to_descr(array.dtype),
+            'shape': list(array.shape), 'chunk_size': chunk_size, 'chunks': sizes}
+
+
+class _CompressedArray(_LazyArray):
+    """Compressed array file of a LazyBunch, inflated in parallel when first accessed"""
+
+    def __init__(self, folder, entry):
+        super().__init__(Path(folder).joinpath(entry['file']))
+        self.entry = entry
+
+    def load(self):
+        entry, chunk_size = self.entry, self.entry['chunk_size']
+        array = np.empty(entry['shape'], dtype=np.lib.format.descr_to_dtype(entry['descr']))
+        data = array.reshape(-1).view(np.uint8)
+        raw = memoryview(self.file.read_bytes())
+        offsets = np.r_[0, np.cumsum(entry['chunks'], dtype=np.int64)]
+
+        def _inflate(i):
+            chunk = zlib.decompress(raw[offsets[i]:offsets[i + 1]])
+            data[i * chunk_size:i * chunk_size + len(chunk)] = np.frombuffer(chunk, dtype=np.uint8)
+
+        with ThreadPoolExecutor() as pool:
+            list(pool.map(_inflate, range(len(entry['chunks']))))
+        return array
+
+
+class LazyBunch(Bunch):
+    """
+    Bunch loaded from a folder written by Bunch.save_dir: arrays are memory-mapped (read-only)
+    on the first access of their key, so that opening a large result only reads its manifest
+    and accessing an array only reads the pages used. Compressed arrays are inflated in memory
+    on first access instead.
+
+    rasters = Bunch.load('/data/rasters')  # LazyBunch
+    rasters.tscale  # memory-mapped on this first access
+    """
+
+    def __init__(self, *args, **kwargs):
+        # the values are not held in the attributes dictionary as for a Bunch, attributes are
+        # looked up through __getattr__ so that they are loaded on first access
+        dict.__init__(self, *args, **kwargs)
+
+    @staticmethod
+    def load_dir(folder):
+        """
+        :param folder: folder written by Bunch.save_dir
+        :return: LazyBunch
+        """
+        folder = Path(folder)
+        manifest = json.loads(folder.joinpath(MANIFEST_FILE).read_text())
+        def _placeholder(f):
+            if f is None:
+                return None
+            if isinstance(f, dict):
+                return _CompressedArray(folder, f)
+            return _LazyArray(folder.joinpath(f))
+
+        return LazyBunch({k: _placeholder(f) for k, f in zip(manifest['keys'], manifest['files'])})
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if isinstance(value, _LazyArray):
+            value = value.load()
+            dict.__setitem__(self, key, value)
+        return value
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key) from None
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+    def __delattr__(self, key):
+        del self[key]
+
+    def __iter__(self):
+        # overriding the dict iterator makes dict(), update and ** unpacking go through __getitem__
+        return iter(self.keys())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *default):
+        value = self[key] if key in self else dict.pop(self, key, *default)
+        dict.pop(self, key, None)
+        return value
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def copy(self):
+        """Return a Bunch of the (memory-mapped) arrays"""
+        return Bunch(self.items())
+
+
+class SpikeTable(Bunch):
+    """
+    Columnar spike container: the columns (times, clusters and any other per-spike array, e.g. depths,
+    amps, _av_shankIDs) are sorted by time once, stored with narrow dtypes (int32 clusters, float32
+    depths), and indexed per cluster (CSR offsets) so that time-window and cluster queries are answered
+    by searchsorted and slicing, without copying the columns.
+
+    spikes = SpikeTable(times, clusters, depths=depths, _av_shankIDs=shank_ids)
+    spikes.window(100, 200).times  # view of the spike times between 100 and 200s
+    spikes.cluster_spike_times(12)  # view of the spike times of cluster 12
+    """
+    # per-cluster index, the spikes of cluster_ids[k] are cluster_order[cluster_offsets[k]:cluster_offsets[k + 1]]
+    INDEX_KEYS = ('cluster_ids', 'cluster_offsets', 'cluster_order', 'times_by_cluster')
+
+    def __init__(self, times, clusters, **columns):
+        times = np.asarray(times)
+        order = np.argsort(times, kind='stable') if np.any(np.diff(times) < 0) else None
+
+        def _column(x, dtype=None):
+            x = np.asarray(x) if order is None else np.asarray(x)[order]
+            return x if dtype is None else x.astype(dtype, copy=False)
+
+        clusters = np.asarray(clusters)
+        cluster_dtype = np.int32 if clusters.size == 0 or np.abs(clusters).max() < 2 ** 31 else np.int64
+        super(SpikeTable, self).__init__(times=_column(times), clusters=_column(clusters, cluster_dtype))
+        for k, v in columns.items():
+            if k in self.INDEX_KEYS:
+                continue
+            self[k] = _column(v, np.float32 if k == 'depths' else None)
+
+        cluster_order = np.argsort(self.clusters, kind='stable')
+        self.cluster_ids, counts = np.unique(self.clusters, return_counts=True)
+        self.cluster_offsets = np.r_[0, np.cumsum(counts)]
+        self.cluster_order = cluster_order
+        self.times_by_cluster = self.times[cluster_order]
+
+    @property
+    def columns(self):
+        """names of the per-spike columns"""
+        return [k for k in self.keys() if k not in self.INDEX_KEYS]
+
+    def window_slice(self, t0, t1):
+        """
+        :return: slice of the spikes with t0 <= times <= t1
+        """
+        return slice(np.searchsorted(self.times, t0, side='left'),
+                     np.searchsorted(self.times, t1, side='right'))
+
+    def window(self, t0, t1):
+        """
+        :return: Bunch of views of the columns for the spikes with t0 <= times <= t1
+        """
+        sl = self.window_slice(t0, t1)
+        return Bunch({k: self[k][sl] for k in self.columns})
+
+    def _cluster_slice(self, cluster_id):
+        k = np.searchsorted(self.cluster_ids, cluster_id)
+        if k == self.cluster_ids.size or self.cluster_ids[k] != cluster_id:
+            return slice(0, 0)
+        return slice(self.cluster_offsets[k], self.cluster_offsets[k + 1])
+
+    def cluster_indices(self, cluster_id):
+        """
+        :return: view of the (time-sorted) indices of the spikes of one cluster
+        """
+        return self.cluster_order[self._cluster_slice(cluster_id)]
+
+    def cluster_spike_times(self, cluster_id):
+        """
+        :return: view of the (sorted) spike times of one cluster
+        """
+        return self.times_by_cluster[self._cluster_slice(cluster_id)]
+
+    def clusters_indices(self, cluster_ids):
+        """
+        :return: time-sorted indices of the spikes of a subset of clusters
+        """
+        indices = [self.cluster_indices(c) for c in np.atleast_1d(cluster_ids)]
+        return np.sort(np.concatenate([np.zeros(0, dtype=self.cluster_order.dtype)] + indices))
+
+
 def save_dict_to_json(dict,path):
     """
     util function to save dictionaries to json
@@ -1,32 +1,79 @@
 # generic functions that are mainly implementations of mathmetical operations
 
 import numpy as np
-from scipy.stats import zscore
+from scipy.fft import irfft, next_fast_len, rfft
 
-def cross_correlation(A, B, zscorea=True, zscoreb=True):
+def _zscore_columns(X, sl, zscore, dtype):
+    """
+    Copy of the columns sl of X in dtype, z-scored along the first axis if zscore is True
+    """
+    if not zscore:
+        return np.asarray(X[:, sl], dtype=dtype)
+    x = np.array(X[:, sl], dtype=dtype)
+    x -= x.mean(axis=0)
+    x /= x.std(axis=0)
+    return x
+
+
+def cross_correlation(A, B, zscorea=True, zscoreb=True, block_size=None, dtype=None, out=None,
+                      max_lag=None):
     '''Compute correlation for each column of A against
     every column of B (e.g. B is predictions).
+    Columns are processed by blocks so that A, B and the output can be memory-mapped arrays
+    larger than memory.
     Parameters
     ----------
     A : 2D np.ndarray (n, p)
     B : 2D np.ndarray (n, q)
+    zscorea, zscoreb : bool, z-score the columns of A, B
+    block_size : int, number of columns of A and of B processed at once (default: all)
+    dtype : compute dtype, e.g. np.float32 (default: float64, float32 for float32 inputs)
+    out : np.ndarray or np.memmap (p, q), or (p, q, 2 * max_lag + 1), written in place
+    max_lag : int, if set, correlations are computed with FFTs for lags -max_lag..max_lag samples:
+        cross_corr[i, j, max_lag + k] = sum_t A[t, i] * B[t + k, j] / n
     Returns
     -------
-    cross_corr : 2D np.ndarray (p, q)
+    cross_corr : 2D np.ndarray (p, q), or 3D np.ndarray (p, q, 2 * max_lag + 1) if max_lag is set
     '''
-    n = A.shape[0]
+    n, p = A.shape
+    q = B.shape[1]
+    if dtype is None:
+        dtype = np.result_type(A.dtype, B.dtype, np.float32)
+    shape = (p, q) if max_lag is None else (p, q, 2 * max_lag + 1)
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise ValueError(f"out has shape {out.shape}, expected {shape}")
+    block_size = block_size or max(p, q)
+    if max_lag is not None:
+        # zero-padding to n + max_lag samples avoids wrapping circular correlations
+        nfft = next_fast_len(n + max_lag, real=True)
 
-    # If needed
-    if zscorea: A = zscore(A)
-    if zscoreb: B = zscore(B)
-    corr = np.dot(A.T, B)/float(n)
-    return corr
+    for ia in range(0, p, block_size):
+        sla = slice(ia, min(ia + block_size, p))
+        a = _zscore_columns(A, sla, zscorea, dtype)
+        if max_lag is not None:
+            a = np.conj(rfft(a, nfft, axis=0))
+        for ib in range(0, q, block_size):
+            slb = slice(ib, min(ib + block_size, q))
+            b = _zscore_columns(B, slb, zscoreb, dtype)
+            if max_lag is None:
+                out[sla, slb] = np.dot(a.T, b) / n
+                continue
+            b = rfft(b, nfft, axis=0)
+            for i in range(a.shape[1]):
+                c = irfft(a[:, i:i + 1] * b, nfft, axis=0)
+                # negative lags wrap to the end of the circular correlation
+                out[ia + i, slb, :max_lag] = c[nfft - max_lag:].T / n
+                out[ia + i, slb, max_lag:] = c[:max_lag + 1].T / n
+    return out
 
 
-def schmitt(x, thresh, minwid=0):
+def _schmitt_thresholds(x, thresh):
     """
-    Schmitt trigger 
+    Low and high thresholds: either given, or a fraction of the range of x centred on its middle
     """
+    thresh = np.asarray(thresh)
     if thresh.size < 2:
         xmax = np.max(x)
         xmin = np.min(x)
@@ -35,35 +82,283 @@ def schmitt(x, thresh, minwid=0):
         low = xmin + low
     else:
         low, high = thresh
+    return low, high
+
+
+class SchmittTrigger:
+    """
+    Streaming Schmitt trigger: processes a signal chunk by chunk and returns the transition
+    indices of each chunk, identical to the t returned by schmitt on the whole signal.
+    The trigger state, and the last transition while it is closer than minwid samples to the end
+    of the chunk, are carried over to the next chunk.
+
+    trigger = SchmittTrigger((low, high), minwid=10)
+    for chunk in chunks:
+        t = trigger.update(chunk)
+    t = trigger.flush()
+    """
+
+    def __init__(self, thresh, minwid=0):
+        """
+        :param thresh: (low, high) thresholds, they can't be computed from the range of the
+         signal as in schmitt as the whole signal is not available
+        :param minwid: minimum number of samples between transitions, shorter states are removed
+        """
+        self.low, self.high = thresh
+        self.minwid = minwid
+        self.n_samples = 0  # samples processed so far
+        self.level = 0  # thresholded value of the last sample: 1 above high, -1 below low, else 0
+        self.last_crossing = 0  # sign of the last threshold crossing
+        self.last_transition = 0  # sign of the last transition returned
+        self.pending = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int8))
+
+    @property
+    def state(self):
+        """Current output of the trigger: 1 high, -1 low, 0 before the first transition"""
+        return int(self.last_transition)
 
-    c = (x > high).astype('int') - (x < low).astype('int')
-    c[1:] = c[1:] * (c[1:] != c[:-1])
-    t = np.where(c)[0]
-    t= np.delete(t,1 + np.where(c[t[1:]] == c[t[:-1]])[0])  # remove duplicates (i.e. wherre two 1s or -1s follow each other)
+    def update(self, x, return_signs=False):
+        """
+        :param x: next chunk of the signal
+        :param return_signs: if True also returns the sign of the transitions (1 up, -1 down)
+        :return: indices of the transitions (from the start of the signal) decided with this chunk
+        """
+        x = np.asarray(x)
+        c = np.zeros(x.size, dtype=np.int8)
+        c[x > self.high] = 1
+        c[x < self.low] = -1
+        # threshold crossings: start of a run above high or below low, alternating in sign
+        prev = np.empty_like(c)
+        prev[:1] = self.level
+        prev[1:] = c[:-1]
+        t = np.flatnonzero((c != 0) & (c != prev))
+        signs = c[t]
+        keep = signs != np.r_[np.int8(self.last_crossing), signs[:-1]]
+        t, signs = t[keep] + self.n_samples, signs[keep]
+        if c.size:
+            self.level = c[-1]
+        if signs.size:
+            self.last_crossing = signs[-1]
+        self.n_samples += x.size
+        if self.minwid >= 1:
+            t = np.r_[self.pending[0], t]
+            signs = np.r_[self.pending[1], signs]
+            # a crossing is kept if the next one is at least minwid samples later, the last
+            # crossing waits until enough samples have been seen
+            keep = np.r_[t[1:] - t[:-1] >= self.minwid, self.n_samples - t[-1:] >= self.minwid]
+            if keep.size and not keep[-1]:
+                self.pending = (t[-1:], signs[-1:])
+            else:
+                self.pending = (t[:0], signs[:0])
+            t, signs = t[keep], signs[keep]
+        return self._transitions(t, signs, return_signs)
 
-    if minwid >= 1:
-        t = t[t[1:] - t[:-1] >= minwid]
-        t = np.delete(t,[1 + np.where(c[t[1:]] == c[t[:-1]])[0]])  # remove duplicates
+    def flush(self, return_signs=False):
+        """
+        Returns the pending transition at the end of the signal, if any
+        """
+        t, signs = self.pending
+        self.pending = (t[:0], signs[:0])
+        return self._transitions(t, signs, return_signs)
 
+    def _transitions(self, t, signs, return_signs):
+        # removes consecutive transitions of the same sign left by the minwid selection
+        keep = signs != np.r_[np.int8(self.last_transition), signs[:-1]]
+        t, signs = t[keep], signs[keep]
+        if signs.size:
+            self.last_transition = signs[-1]
+        return (t, signs) if return_signs else t
 
-    y = np.zeros(c.size)
-    y[t] = 2 * c[t]
-    y[t[0]] = c[t[0]]
-    y = np.cumsum(y)
 
+def iter_schmitt(x, thresh, minwid=0, chunk_size=2 ** 20):
+    """
+    Streaming Schmitt trigger, yields the transition indices chunk by chunk (see SchmittTrigger)
+    :param x: signal, array-like (e.g. memory-mapped) read by chunks of chunk_size samples,
+     or an iterable of chunks
+    :param thresh: (low, high) thresholds
+    :param minwid: minimum number of samples between transitions
+    :return: generator of arrays of transition indices, their concatenation is the t of schmitt
+    """
+    trigger = SchmittTrigger(thresh, minwid=minwid)
+    chunks = x
+    if hasattr(x, 'shape'):
+        chunks = (x[i:i + chunk_size] for i in range(0, x.shape[0], chunk_size))
+    for chunk in chunks:
+        yield trigger.update(chunk)
+    yield trigger.flush()
+
+
+def schmitt(x, thresh, minwid=0):
+    """
+    Schmitt trigger
+    :param x: 1d array
+    :param thresh: (low, high) thresholds, or a scalar fraction of the range of x
+    :param minwid: minimum number of samples between transitions: crossings followed by another
+     crossing less than minwid samples later are removed, which removes short states
+    :return: y, the trigger output (1 high, -1 low, 0 before the first transition), and t,
+     the indices of the transitions
+    """
+    low, high = _schmitt_thresholds(x, thresh)
+    trigger = SchmittTrigger((low, high), minwid=minwid)
+    t, signs = trigger.update(x, return_signs=True)
+    t_end, signs_end = trigger.flush(return_signs=True)
+    t, signs = np.r_[t, t_end], np.r_[signs, signs_end]
+    y = np.repeat(np.r_[0, signs].astype(float), np.diff(np.r_[0, t, np.size(x)]))
     return y, t
 
+
+def intervals_to_mask(t, starts, ends, count=False):
+    """
+    Marks the timepoints falling in intervals, in O(len(t) + len(starts)): the first and last
+    timepoints of each interval are found by searchsorted, and a cumulative sum of +1/-1 markers
+    paints the intervals
+    :param t: sorted timepoints (e.g. camera frame times)
+    :param starts: start times of the intervals (e.g. on times)
+    :param ends: end times of the intervals (e.g. off times), ends are included
+    :param count: if True, returns the number of intervals containing each timepoint instead of a mask
+    :return: boolean mask (or int counts) of the same size as t, True where starts <= t <= ends
+    """
+    t = np.asarray(t)
+    first = np.searchsorted(t, starts, side='left')
+    last = np.searchsorted(t, ends, side='right')
+    valid = first < last
+    markers = np.bincount(first[valid], minlength=t.size + 1) - np.bincount(last[valid], minlength=t.size + 1)
+    counts = np.cumsum(markers[:-1])
+    return counts if count else counts > 0
+
+
+def kmeans_1d(x, n_clusters=5, n_bins=1024, n_fine=16, max_iter=100):
+    """
+    Deterministic 1D k-means, linear in the number of points:
+        1. the values are binned once in n_bins * n_fine fine bins (half of the edges on quantiles,
+        half evenly spaced so that the tails are resolved)
+        2. the optimal partition of n_bins groups of fine bins in n_clusters contiguous clusters
+        (minimum within-cluster sum of squares of the bin means weighted by the bin counts) is
+        found by dynamic programming in O(n_clusters * n_bins ** 2)
+        3. the clusters are refined by Lloyd iterations on the fine bins means, and each value is
+        assigned to its nearest center
+    :param x: 1d array
+    :param n_clusters: number of clusters
+    :param n_bins: number of bins of the dynamic programming
+    :param n_fine: number of fine bins per bin
+    :param max_iter: maximum number of Lloyd iterations
+    :return: centers (n_clusters, ascending), labels (same size as x)
+    """
+    x = np.ravel(x)
+    nf = n_bins * n_fine
+    edges = np.unique(np.r_[np.quantile(x, np.linspace(0, 1, nf // 2 + 1)),
+                            np.linspace(x.min(), x.max(), nf // 2 + 1)])
+    ibin = np.clip(np.searchsorted(edges, x, side='right') - 1, 0, max(edges.size - 2, 0))
+    # fine bins counts and means (centred for numerical precision), empty bins are dropped
+    x0 = x.mean()
+    w = np.bincount(ibin).astype(np.float64)
+    sx = np.bincount(ibin, weights=x - x0)
+    keep = w > 0
+    # the groups are formed on the fine bins positions before dropping the empty ones, so that a
+    # group never spans a gap in the data; empty groups are dropped as well
+    group = np.unique((np.arange(w.size) * n_bins // w.size)[keep], return_inverse=True)[1]
+    w, mx = w[keep], sx[keep] / w[keep]
+    # dynamic programming on groups of fine bins
+    gw, gsx = np.bincount(group, weights=w), np.bincount(group, weights=w * mx)
+    W, S1, S2 = (np.r_[0, np.cumsum(v)] for v in (gw, gsx, gsx ** 2 / gw))
+    # cost[i, j]: sum of squares of the groups i to j - 1 as one cluster
+    i, j = np.triu_indices(gw.size + 1, 1)
+    cost = np.full((gw.size + 1, gw.size + 1), np.inf)
+    cost[i, j] = S2[j] - S2[i] - (S1[j] - S1[i]) ** 2 / (W[j] - W[i])
+    n_clusters = min(n_clusters, gw.size)
+    dist, splits = cost[0], []
+    for _ in range(n_clusters - 1):
+        total = dist[:, np.newaxis] + cost
+        splits.append(np.argmin(total, axis=0))
+        dist = total[splits[-1], np.arange(total.shape[1])]
+    # backtrack the cluster boundaries from the last group
+    bounds = [gw.size]
+    for split in splits[::-1]:
+        bounds.append(split[bounds[-1]])
+    labels = np.repeat(np.arange(n_clusters), np.diff(np.r_[0, bounds[::-1]]))[group]
+    # Lloyd iterations on the fine bins: in 1D the nearest center boundaries are the midpoints
+    # between consecutive centers
+    for _ in range(max_iter):
+        centers = np.bincount(labels, weights=w * mx) / np.bincount(labels, weights=w)
+        new_labels = np.searchsorted((centers[1:] + centers[:-1]) / 2, mx)
+        if np.array_equal(new_labels, labels) or np.unique(new_labels).size < n_clusters:
+            break
+        labels = new_labels
+    labels_x = np.searchsorted((centers[1:] + centers[:-1]) / 2, x - x0)
+    counts = np.bincount(labels_x, minlength=n_clusters)
+    if np.any(counts == 0):
+        # a wide fine bin can straddle a whole cluster: keep the fine bins labels, none is empty
+        labels_x = labels[np.cumsum(keep)[ibin] - 1]
+        counts = np.bincount(labels_x, minlength=n_clusters)
+    centers = np.bincount(labels_x, weights=x, minlength=n_clusters) / counts
+    return centers, labels_x
+
+
+class MemberIndex:
+    """
+    Index over the values of b, built once and reused by ismember for repeated queries against
+    the same b. Integer values spanning a small range use a dense lookup table, other values
+    (e.g. large integer ids, floats, strings) a sorted copy of b searched with np.searchsorted.
+
+    index = MemberIndex(regions.id)
+    lia, locb = ismember(a, index)
+    """
+
+    def __init__(self, b, lut_max_size=2 ** 20):
+        """
+        :param b: array-like, flattened
+        :param lut_max_size: a lookup table is used when the range of integer values of b is
+         below max(lut_max_size, 4 * b.size)
+        """
+        self.b = np.asarray(b)
+        # unique values, and the index of their first occurrence in b
+        self.values, self.indices = np.unique(self.b.ravel(), return_index=True)
+        self.lut = None
+        if self.values.size and self.values.dtype.kind in 'iu':
+            self.vmin, self.vmax = int(self.values[0]), int(self.values[-1])
+            if self.vmax - self.vmin < max(lut_max_size, 4 * self.values.size):
+                self.lut = np.full(self.vmax - self.vmin + 1, -1, dtype=np.intp)
+                self.lut[self.values - self.vmin] = self.indices
+
+    def locate(self, a):
+        """
+        Location of the first occurrence of each element of a in b
+        :param a: nd-array
+        :return: array of indices of the same shape as a, -1 where a is not in b
+        """
+        a = np.asarray(a)
+        loc = np.full(a.shape, -1, dtype=np.intp)
+        if self.values.size == 0:
+            return loc
+        if self.lut is not None and a.dtype.kind in 'iu':
+            inrange = (a >= self.vmin) & (a <= self.vmax)
+            loc[inrange] = self.lut[a[inrange].astype(np.int64) - self.vmin]
+            return loc
+        pos = np.searchsorted(self.values, a)
+        pos[pos == self.values.size] = 0
+        found = self.values[pos] == a
+        loc[found] = self.indices[pos[found]]
+        return loc
+
+    def query(self, a):
+        """
+        :param a: nd-array
+        :return: isin, locb as returned by ismember
+        """
+        loc = self.locate(a)
+        lia = loc >= 0
+        return lia, loc[lia]
+
+
 def ismember(a, b):
     """
     equivalent of np.isin but returns indices as in the matlab ismember function
     returns an array containing logical 1 (true) where the data in A is B
     also returns the location of members in b such as a[lia] == b[locb]
-    :param a: 1d - array
-    :param b: 1d - array
+    (first occurrence in b for repeated values)
+    :param a: nd - array
+    :param b: 1d - array, or a MemberIndex prebuilt over b for repeated queries
     :return: isin, locb
     """
-    lia = np.isin(a, b)
-    aun, _, iuainv = np.unique(a[lia], return_index=True, return_inverse=True)
-    _, ibu, iau = np.intersect1d(b, aun, return_indices=True)
-    locb = ibu[iuainv]
-    return lia, locb
\ No newline at end of file
+    index = b if isinstance(b, MemberIndex) else MemberIndex(b)
+    return index.query(a)
@@ -1,10 +1,192 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.signal as signal
 from sklearn.cluster import KMeans
 
 from .plotting import off_axes
-from .numerical import schmitt
+from .numerical import schmitt, kmeans_1d, intervals_to_mask
+
+
+def _frame_chunks(frames,chunk_size):
+    """chunks of chunk_size frames, sliced from an array or stacked from a frame iterator"""
+    if hasattr(frames,'shape'):
+        for first in range(0,frames.shape[0],chunk_size):
+            yield frames[first:first+chunk_size]
+        return
+    chunk = []
+    for frame in frames:
+        chunk.append(frame)
+        if len(chunk)==chunk_size:
+            yield np.stack(chunk)
+            chunk = []
+    if chunk:
+        yield np.stack(chunk)
+
+
+def _roi_pixels(chunk,roi):
+    """pixels of the roi in a chunk of frames, as n_frames x n_pixels"""
+    if roi is None:
+        pixels = chunk
+    elif isinstance(roi,tuple):
+        pixels = chunk[(slice(None),)+roi]
+    else:
+        pixels = chunk[:,roi]
+    pixels = np.asarray(pixels)
+    # signed differences without overflow (e.g. uint8 -> int16)
+    return pixels.reshape(pixels.shape[0],-1).astype(np.promote_types(pixels.dtype,np.int16))
+
+
+def iter_motion_energy(frames,frame_times=None,fs=None,rois=None,chunk_size=500,n_threads=1):
+    """
+    Streaming motion energy of a video: sum over the pixels of each roi of the absolute difference
+    between consecutive frames. Frames are read by chunks, and the last frame of each chunk is 
+    carried over to the next one, so that memory does not depend on the length of the video.
+    The first frame has no previous frame, it is given the motion energy of the second one. 
+
+    Parameters: 
+    -----------
+    frames: np.ndarray or iterable
+        n_frames x height x width array (e.g. np.memmap of the raw video), or an iterable of frames
+    frame_times: np.ndarray
+        time of each frame
+    fs: float
+        frame rate, used if frame_times is not given (camt starts at 0)
+    rois: list 
+        regions of interest, each a (rows, columns) tuple of slices or a height x width boolean mask. 
+        If None, the motion energy of the whole frame is returned
+    chunk_size: int
+        number of frames read at once
+    n_threads: int
+        number of threads computing the rois of each chunk in parallel
+
+    Returns: 
+    -------
+    generator of (camt,camv) for each chunk: camv is 1d if rois is None, chunk x n_rois otherwise
+    """
+    if frame_times is None and fs is None:
+        raise ValueError("either frame_times or fs should be given")
+    roi_list = [None] if rois is None else list(rois)
+    previous = [None]*len(roi_list)
+    # the first chunk needs a second frame to estimate the first one
+    chunk_size = max(chunk_size,2)
+
+    def _roi_energy(iroi,chunk):
+        pixels = _roi_pixels(chunk,roi_list[iroi])
+        if previous[iroi] is not None:
+            pixels = np.concatenate([previous[iroi][np.newaxis],pixels])
+        energy = np.abs(np.diff(pixels,axis=0)).sum(axis=1).astype(np.float64)
+        if previous[iroi] is None:
+            energy = np.r_[energy[:1] if energy.size else 0.,energy]
+        previous[iroi] = pixels[-1]
+        return energy
+
+    n_frames = 0
+    with ThreadPoolExecutor(n_threads) as pool:
+        for chunk in _frame_chunks(frames,chunk_size):
+            camv = np.stack(list(pool.map(lambda iroi: _roi_energy(iroi,chunk),range(len(roi_list)))),axis=1)
+            if frame_times is not None:
+                camt = np.asarray(frame_times[n_frames:n_frames+camv.shape[0]],dtype=np.float64)
+            else:
+                camt = (n_frames+np.arange(camv.shape[0]))/fs
+            n_frames += camv.shape[0]
+            yield camt,(camv[:,0] if rois is None else camv)
+
+
+def motion_energy(frames,frame_times=None,fs=None,rois=None,chunk_size=500,n_threads=1):
+    """
+    Motion energy of a video computed by chunks, see iter_motion_energy for the parameters
+    
+    Returns: 
+    -------
+    (camt,camv): (numpy ndarrays) ready for digitise_motion_energy and get_move_raster, camv is 1d 
+    if rois is None, n_frames x n_rois otherwise
+    """
+    chunks = list(iter_motion_energy(frames,frame_times=frame_times,fs=fs,rois=rois,
+                                     chunk_size=chunk_size,n_threads=n_threads))
+    if not chunks:
+        return np.zeros(0),np.zeros((0,) if rois is None else (0,len(rois)))
+    camt,camv = zip(*chunks)
+    return np.concatenate(camt),np.concatenate(camv)
+
+
+class TraceInterpolator:
+    """
+    Linear interpolation of a behavioral trace (camera/wheel) at arbitrary times, equivalent to 
+    np.interp(t, camt, camv), built once per trace and reused for many sets of events: the trace
+    is flattened, sorted if needed and converted once, and queries are processed by chunks so
+    that the full events x bins grid of times is never allocated.
+
+    Parameters:
+    -----------
+    camt: np.ndarray 
+        camera timepoints (same length as camv)
+    camv: np.ndarray
+        camera values 
+    dtype: np.dtype
+        dtype of the interpolated output (e.g. np.float32), times are always float64
+    chunk_size: int
+        number of query points processed at once
+    """
+
+    def __init__(self, camt, camv, dtype=np.float64, chunk_size=2**18):
+        camt = np.ascontiguousarray(np.ravel(camt), dtype=np.float64)
+        camv = np.ascontiguousarray(np.ravel(camv), dtype=np.float64)
+        if np.any(np.diff(camt) < 0):
+            order = np.argsort(camt, kind='stable')
+            camt, camv = camt[order], camv[order]
+        self.camt, self.camv = camt, camv
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+
+    def __call__(self, t):
+        """
+        Parameters:
+        -----------
+        t: np.ndarray 
+            query times (any shape)
+
+        Returns:
+        --------
+        values: np.ndarray
+            trace values interpolated at t, clamped to the first/last values outside of camt
+        """
+        t = np.asarray(t, dtype=np.float64)
+        tflat = t.reshape(-1)
+        values = np.empty(tflat.size, dtype=self.dtype)
+        for first in range(0, tflat.size, self.chunk_size):
+            sl = slice(first, first + self.chunk_size)
+            # np.interp starts each binary search from the previous index, which makes locally
+            # sorted queries such as rasters close to O(1) per point
+            values[sl] = np.interp(tflat[sl], self.camt, self.camv)
+        return values.reshape(t.shape)
+
+    def raster(self, on_times, bin_range, out=None):
+        """
+        Parameters:
+        -----------
+        on_times: np.ndarray
+            event times
+        bin_range: np.ndarray
+            timepoints of the raster relative to the events
+        out: np.ndarray 
+            optional output array (len(on_times) x len(bin_range)), e.g. memory-mapped
+
+        Returns:
+        --------
+        raster: np.ndarray
+            len(on_times) x len(bin_range) trace values, computed by chunks of events
+        """
+        on_times, bin_range = np.ravel(on_times), np.ravel(bin_range)
+        if out is None:
+            out = np.empty((on_times.size, bin_range.size), dtype=self.dtype)
+        n_events = max(1, self.chunk_size // max(1, bin_range.size))
+        for first in range(0, on_times.size, n_events):
+            sl = slice(first, first + n_events)
+            out[sl] = np.interp(on_times[sl, np.newaxis] + bin_range, self.camt, self.camv)
+        return out
 
 
 def get_move_raster(on_times,camt,camv,pre_time=.1,post_time=1,bin_size=.005,sortPC1=False,sortAmp=False,baseline_subtract=True,ax=None,to_plot=False):
@@ -16,8 +198,9 @@ def get_move_raster(on_times,camt,camv,pre_time=.1,post_time=1,bin_size=.005,sor
     -----------
     on_times: list 
         instances of onsets (same scale as camt)
-    camt: np.ndarray 
-        camera timepoints (same length as camv)
+    camt: np.ndarray or TraceInterpolator
+        camera timepoints (same length as camv), or an interpolator of the trace built once 
+        to compute many rasters (camv is then ignored)
     camv: np.ndarray
         camera values 
     pre_time: float
@@ -50,17 +233,15 @@ def get_move_raster(on_times,camt,camv,pre_time=.1,post_time=1,bin_size=.005,sor
 
     """
     # If requested, input on_times in a sorted fashion
-    on_times = on_times[:,np.newaxis]
+    interpolator = camt if isinstance(camt, TraceInterpolator) else TraceInterpolator(camt, camv)
     bin_range = np.arange(-pre_time,post_time,bin_size)
     zero_bin_idx = np.argmin(np.abs(bin_range))
-    raster = np.interp((on_times+bin_range),np.ravel(camt),np.ravel(camv))
+    raster = interpolator.raster(on_times, bin_range)
 
     sort_idx = None
 
     if baseline_subtract: 
-        baseline = raster[:,zero_bin_idx][:,np.newaxis]
-        baseline = np.tile(baseline,bin_range.size)
-        raster = raster - baseline 
+        raster -= raster[:,zero_bin_idx][:,np.newaxis]
 
     if sortPC1:
         mu,_,_ = np.linalg.svd(raster[zero_bin_idx:,:],full_matrices=False)
@@ -86,42 +267,103 @@ def get_move_raster(on_times,camt,camv,pre_time=.1,post_time=1,bin_size=.005,sor
     return raster,bin_range,sort_idx
 
 
-def digitise_motion_energy(camt,camv,plot_sample=False,min_off_time=.01,min_on_time =.01):
+@lru_cache(maxsize=32)
+def _lowpass_sos(fs,fc,order):
     """
-    converts camera motion energy signal to digitised motion on/off
-    process: 
-        1. lowpass (<10Hz) 7th order Butterworth
-        2. kmeans to determine min threshold 
-        3. drop periods that don't last min_period time (s)
+    Butterworth low pass design in second-order sections, cached per sampling rate, and the number
+    of samples after which its impulse response has decayed (used as the overlap of chunks)
+    """
+    sos = signal.butter(order,fc/(fs/2),'low',output='sos')
+    n = int(np.ceil(fs/fc))*order*8
+    impulse = signal.sosfilt(sos,np.r_[1.,np.zeros(n-1)])
+    n_settle = np.flatnonzero(np.abs(impulse)>1e-9*np.abs(impulse).max())[-1]+1
+    return sos,n_settle
+
+
+def lowpass_filtfilt(x,fs,fc=10,order=7,chunk_size=None,overlap=None):
+    """
+    zero-phase Butterworth low pass of one or many traces along time 
 
     Parameters: 
     -----------
-    camt: numpy ndarray
-    camv: numpy ndarray
-    plot_sample: bool
-    min_period_time: float64
+    x: numpy ndarray
+        trace (n_samples), or traces (n_samples x n_traces, e.g. one per roi) filtered together
+    fs: float
+        sampling rate
+    fc: float
+        frequency cutoff
+    order: int
+        order of the Butterworth filter
+    chunk_size: int
+        if given, the traces are filtered by chunks of chunk_size samples, each padded with 
+        overlap samples of the trace on both sides (overlap-save) 
+    overlap: int
+        default: number of samples for the impulse response of the filter to decay to 1e-9
 
     Returns: 
     -------
-    (on_times,off_times,digitised) : (numpy ndarrays)
+    x_filt: numpy ndarray (same shape as x)
+    """
+    sos,n_settle = _lowpass_sos(float(fs),fc,order)
+    x = np.asarray(x)
+    if chunk_size is None or chunk_size>=x.shape[0]:
+        return signal.sosfiltfilt(sos,x,axis=0)
+    overlap = 2*n_settle if overlap is None else overlap
+    x_filt = np.empty(x.shape,dtype=np.result_type(x.dtype,np.float64))
+    for first in range(0,x.shape[0],chunk_size):
+        last = min(first+chunk_size,x.shape[0])
+        start,stop = max(first-overlap,0),min(last+overlap,x.shape[0])
+        x_filt[first:last] = signal.sosfiltfilt(sos,x[start:stop],axis=0)[first-start:last-start]
+    return x_filt
 
 
+def _motion_thresholds(camv,camv_filt,threshold_method='kmeans',n_bins=1024):
     """
+    low and high thresholds of the motion energy: the low threshold is the center of the lowest 
+    cluster (of the clusters with more than 2% of the points), the high threshold is one 
+    standard deviation of the filtered trace in this cluster above
 
-    fs = 1/np.diff(camt).mean()
-    fc = 10  # frequency cutoff
-    w  = fc / (fs/2)
-    b,a = signal.butter(7,w,'low')
-    camv_filt = signal.filtfilt(b, a, camv)
+    Parameters: 
+    -----------
+    camv: numpy ndarray
+    camv_filt: numpy ndarray
+        filtered camv
+    threshold_method: str
+        'kmeans' (sklearn KMeans on all points) or 'histogram' (deterministic 1D k-means on binned values)
+    n_bins: int
+        number of bins for the 'histogram' method
+
+    Returns: 
+    -------
+    (low_up_thr,centers): (numpy ndarrays)
+    """
+    if threshold_method == 'kmeans':
+        k_clus  = KMeans(n_clusters=5).fit(camv[:,np.newaxis])
+        centers, labels = k_clus.cluster_centers_[:,0], k_clus.labels_
+    elif threshold_method == 'histogram':
+        centers, labels = kmeans_1d(camv,n_clusters=5,n_bins=n_bins)
+    else:
+        raise ValueError(f"threshold_method should be 'kmeans' or 'histogram', got {threshold_method}")
 
-    k_clus  = KMeans(n_clusters=5).fit(camv[:,np.newaxis])
     # remove clusters with less than 2% points
-    keep_idx = [(k_clus.labels_==clusIdx).mean()>.02 for clusIdx in np.unique(k_clus.labels_)]
-    # get the center of each of the remainder of the clusters. 
-    thresh = k_clus.cluster_centers_[keep_idx,0]
-    thresh = np.min(thresh)#+np.ptp(thresh)*0.02 # determine the minimum thershold for crossing
-    std_low = np.std(camv_filt[k_clus.labels_==np.argmin(thresh)])
-    low_up_thr = np.array([thresh,thresh+std_low])
+    counts = np.bincount(labels,minlength=centers.size)
+    keep_idx = np.flatnonzero(counts>.02*labels.size)
+    # the minimum of the centers of the remaining clusters is the threshold for crossing
+    low_clus = keep_idx[np.argmin(centers[keep_idx])]
+    thresh = centers[low_clus]
+    std_low = np.std(camv_filt[labels==low_clus])
+    return np.array([thresh,thresh+std_low]),centers
+
+
+def _digitise_trace(camt,camv,camv_filt,min_off_time,min_on_time,threshold_method,n_bins):
+    """
+    digitises a single motion energy trace, see digitise_motion_energy
+
+    Returns: 
+    -------
+    (on_times,off_times,digitised,centers) : (numpy ndarrays)
+    """
+    low_up_thr,centers = _motion_thresholds(camv,camv_filt,threshold_method=threshold_method,n_bins=n_bins)
     # schmitt trigger of the trace
     camv_thr,_ = schmitt(camv,low_up_thr)
 
@@ -135,15 +377,12 @@ def digitise_motion_energy(camt,camv,plot_sample=False,min_off_time=.01,min_on_t
     # on_times = camt[df_camv_thr>0]
     # off_times = camt[df_camv_thr<0]
 
-    while on_times.size!=off_times.size: 
-        # if stating in on state
-        if camv_thr[0]>=0: 
-            on_times = np.insert(on_times,0,camt[0])
-        elif camv_thr[-1]>0: 
-            off_times = np.insert(off_times,0,camt[-1])
-        else: 
-            print('more on off differences than expected...') 
-            break
+    # if starting in on state, the first epoch starts at the first timepoint
+    if off_times.size and (on_times.size==0 or off_times[0]<on_times[0]):
+        on_times = np.insert(on_times,0,camt[0])
+    # if ending in on state, the last epoch ends at the last timepoint
+    if on_times.size>off_times.size:
+        off_times = np.append(off_times,camt[-1])
 
 
 
@@ -157,17 +396,63 @@ def digitise_motion_energy(camt,camv,plot_sample=False,min_off_time=.01,min_on_t
         on_times, off_times = on_times[np.insert(is_sel,0,True)],off_times[np.insert(is_sel,-1,True)]
 
     # digitis e the signal
-    digitised = np.concatenate([((camt>=on) & (camt<=off))[:,np.newaxis] for on,off in zip(on_times,off_times)],axis=1)
-    digitised  = np.sum(digitised,axis=1)
+    digitised = intervals_to_mask(camt,on_times,off_times,count=True)
+    return on_times,off_times,digitised,centers
+
+
+def digitise_motion_energy(camt,camv,plot_sample=False,min_off_time=.01,min_on_time =.01,threshold_method='kmeans',n_bins=1024,chunk_size=None):
+    """
+    converts camera motion energy signal to digitised motion on/off
+    process: 
+        1. lowpass (<10Hz) 7th order Butterworth (zero-phase, second-order sections)
+        2. kmeans to determine min threshold 
+        3. drop periods that don't last min_period time (s)
+
+    Parameters: 
+    -----------
+    camt: numpy ndarray
+    camv: numpy ndarray
+        motion energy trace (n_frames), or traces (n_frames x n_rois) filtered together
+    plot_sample: bool
+    min_period_time: float64
+    threshold_method: str
+        'kmeans' fits sklearn KMeans on all points (default), 'histogram' is a deterministic 
+        1D k-means on n_bins bins of camv, linear in the number of points
+    n_bins: int
+    chunk_size: int
+        if given, the traces are low passed by overlapping chunks of chunk_size frames
+
+    Returns: 
+    -------
+    (on_times,off_times,digitised) : (numpy ndarrays)
+        for 2d camv, on_times and off_times are lists with one array per roi, 
+        and digitised is n_frames x n_rois
+
+
+    """
+
+    fs = 1/np.diff(camt).mean()
+    camv = np.asarray(camv)
+    camv_filt = lowpass_filtfilt(camv,fs,fc=10,order=7,chunk_size=chunk_size)
+
+    if camv.ndim==1:
+        on_times,off_times,digitised,centers = _digitise_trace(
+            camt,camv,camv_filt,min_off_time,min_on_time,threshold_method,n_bins)
+    else:
+        rois = [_digitise_trace(camt,camv[:,i],camv_filt[:,i],min_off_time,min_on_time,threshold_method,n_bins)
+                for i in range(camv.shape[1])]
+        on_times,off_times = [r[0] for r in rois],[r[1] for r in rois]
+        digitised = np.stack([r[2] for r in rois],axis=1)
+        centers = rois[0][3]
 
     if plot_sample: 
+        # first roi for 2d camv
         st = 2500
         en = 10500
         _,ax = plt.subplots(1,1,figsize=(20,5))
-        plt.plot(camt[st:en],camv[st:en])
-        plt.plot(camt[st:en],camv_filt[st:en])
+        plt.plot(camt[st:en],camv.reshape(camv.shape[0],-1)[st:en,0])
+        plt.plot(camt[st:en],camv_filt.reshape(camv.shape[0],-1)[st:en,0])
         #plt.plot(camt[st:en],camv_thr[st:en])
-        plt.plot(camt[st:en],digitised[st:en]*np.max(k_clus.cluster_centers_)*1.1)
+        plt.plot(camt[st:en],digitised.reshape(camv.shape[0],-1)[st:en,0]*np.max(centers)*1.1)
 
     return (on_times,off_times,digitised)
-